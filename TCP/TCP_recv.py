@@ -6,179 +6,628 @@ __author__ = 'Sirui Tan'
 
 from socket import *
 import sys
+import os
 import pdb
-import struct
-import filecmp
-import datetime
+import getopt
+import select
+import signal
+import hashlib
+import checksum
+import codec
+import eventlog
+import time
+import zlib
+import batchio
+import metrics
+from reorder import ReorderBuffer, BlockBitmap, unwrap
 
-MSS = 532 # Here the MSS must be equal to that of sender's
+MSS = 532 # the sender's MSS unless its SYN tells, TCP header included
+SACK_BLOCKS = 4 # as many as fit in the 40 bytes of TCP options
+ACK_DELAY = 0.04 # longest an in-order segment waits for its ACK, seconds
+BUFFER_SIZE = 262144 # default receive buffer, bytes
+LINGER = 120 # seconds a server answers FINs of a closed connection
+# Most data and seconds between two checkpoints of a resumable transfer.
+CHECKPOINT_BYTES, CHECKPOINT_INTERVAL = 1 << 20, 1.0
+# Data read back from the file at a time to digest what positional writes
+# put there, once that much is in order.
+DIGEST_CHUNK = 1 << 20
+# Metrics in the summary line of the -I option.
+SUMMARY = ['bytes_in_order', 'segments_received', 'segments_discarded', \
+           'out_of_order_bytes', 'window_bytes']
 
 class Receiver:
-    def __init__(self, fileName, lPort, sIP, sPort, logName):
-        self.Sok = socket(AF_INET, SOCK_DGRAM)
-        self.Sok.bind(('', lPort))
-        self.FromIP = gethostbyname(gethostname())
+    def __init__(self, fileName, lPort, sIP, sPort, logName, sack=False, \
+                 binaryLog=False, logSample=1, delayedAck=False, \
+                 bufferSize=BUFFER_SIZE, positional=False, mmsg=False, \
+                 sok=None, fromIP=None, mss=codec.MAX_MSS, resume=False, \
+                 metricsInterval=None, metricsEndpoint=None):
+        # A Server passes its own socket, shared by all its connections.
+        self.OwnSocket = sok is None
+        if self.OwnSocket:
+            sok = socket(AF_INET, SOCK_DGRAM)
+            sok.bind(('', lPort))
+            # The kernel must take a window of large segments at once.
+            sok.setsockopt(SOL_SOCKET, SO_RCVBUF, bufferSize)
+        self.Sok = sok
+        # ACKs are queued in Out and leave in batches, once the segments
+        # read at once are dealt with. mmsg uses sendmmsg and recvmmsg.
+        # Only a receiver reading its own socket needs In: the server
+        # reads for all of its connections.
+        self.Out = batchio.Writer(sok, mmsg)
+        self.In = batchio.Reader(sok, mss, mmsg) if self.OwnSocket else None
+        # The largest segment taken, TCP header included, which the SYN-ACK
+        # tells the sender, and the MSS of the connection once its SYN
+        # arrived. Largest is the largest payload received so far.
+        self.MaxMSS, self.MSS, self.Largest = mss, MSS, 0
+        self.FromIP = fromIP or gethostbyname(gethostname())
         self.ToIP, self.ToPort, self.LPort = sIP, sPort, lPort
-        self.RecvBuffer, self.UnackBuffer = [], []
-        self.ExpSeqNum = 0
-        self.Log = open(logName, 'w')
-        self.File = open(fileName, 'w')
-        self.Record = []
+        # UnackBuffer holds out-of-order segments keyed by unwrapped
+        # offset; ExpOffset is the unwrapped counterpart of ExpSeqNum.
+        self.RecvBuffer, self.UnackBuffer = [], ReorderBuffer()
+        self.ExpSeqNum, self.ExpOffset = 0, 0
+        self.Log = eventlog.openLog(logName, self.FromIP, sIP, binaryLog, \
+                                    logSample)
+        # With resume, the length of the stream and the data contiguous
+        # from its start that is on disk are recorded in the checkpoint
+        # file now and then, Saved bytes at SavedAt last. A transfer of a
+        # stream of the same length then picks up from there, so the file
+        # is only truncated there once the SYN tells the length.
+        self.Checkpoint = fileName + '.ckpt' if resume else None
+        self.Length, self.Saved, self.SavedAt = None, 0, time.time()
+        if resume and os.path.isfile(fileName):
+            self.File = open(fileName, 'r+b')
+        else: # positional mode reads back what it wrote
+            self.File = open(fileName, 'w+b' if positional else 'wb')
+        # In positional mode every payload is written at its own offset as
+        # soon as it arrives, and UnackBuffer is a bitmap of the blocks
+        # received instead of a copy of out-of-order payloads.
+        self.Positional = positional
+        if positional:
+            self.UnackBuffer = BlockBitmap(codec.UNIT)
+        # Decompressor in-order data goes through on its way to File once
+        # compression is accepted, which a SYN may offer unless payloads
+        # are written in place or the stream is resumable, as both need
+        # the offsets of the file to be those of the stream.
+        self.Inflater = None
+        # SHA-256 digest of the data written, in order, which the FIN-ACK
+        # carries back. Data written in place is read back from the file
+        # up to Hashed. A resumed transfer digests what it writes, from
+        # where it resumes. Verified is whether it matches the digest of
+        # the FIN, None if it has none.
+        self.Digest, self.Hashed, self.Verified = hashlib.sha256(), 0, None
+        self.FinOptions = b''
+        # With SACK, ACKs also report the out-of-order blocks held in
+        # UnackBuffer, the block of the latest arrival first.
+        self.SACK = sack
+        # With delayed ACKs, in-order full segments are ACKed in pairs or
+        # once ACKDeadline passes. Unacked counts those not ACKed yet.
+        self.DelayedACK, self.Unacked, self.ACKDeadline = delayedAck, 0, None
+        # Receive buffer shared by in-order data not yet written to File and
+        # out-of-order data. ACKs advertise the room left beyond ExpSeqNum,
+        # in units of 2 ** WindowShift bytes (window scale option, RFC
+        # 7323), and segments beyond it are dropped.
+        self.BufferSize, self.WindowShift = bufferSize, 0
+        while bufferSize >> self.WindowShift > 65535:
+            self.WindowShift += 1
+        self.Advertised = bufferSize # window of the last ACK, bytes
+        # Segments received, payload bytes received, segments discarded
+        # as duplicates or beyond the window, and ACKs sent.
+        self.Stat = [0, 0, 0, 0]
+        # Live metrics, summarized on stderr every metricsInterval seconds
+        # and served at metricsEndpoint if given.
+        self.Metrics = metrics.Registry()
+        self.MetricsAt = (metricsInterval, metricsEndpoint)
+        self._register()
+
+    '''
+    Register the metrics of the transfer, which read its state when a
+    snapshot is taken.
+    '''
+    def _register(self):
+        m, stat = self.Metrics, self.Stat
+        m.counter('segments_received', lambda: stat[0])
+        m.counter('bytes_received', lambda: stat[1])
+        m.counter('segments_discarded', lambda: stat[2])
+        m.counter('acks_sent', lambda: stat[3])
+        m.counter('bytes_in_order', lambda: self.ExpOffset)
+        m.gauge('out_of_order_bytes', self._outOfOrder)
+        m.gauge('window_bytes', lambda: self.Advertised)
+
+    '''
+    Bytes held out of order, in blocks received in positional mode.
+    '''
+    def _outOfOrder(self):
+        if self.Positional:
+            return len(self.UnackBuffer) * codec.UNIT
+        return self.UnackBuffer.Bytes
 
     '''
     The main receiver function
     '''
     def run(self):
-        while True:
-            message, addr = self.Sok.recvfrom(MSS)
-            if self.notCorrupt(message):
-                if len(message) > 20: # messages other than FIN have contents
-                    self.dealWithMess(message)
-                    self.sendACK()
-                    while self.RecvBuffer != []:
-                        self.File.write(self.RecvBuffer.pop(0))
-                else:
-                    self.finish(message)
-                    break
+        done = False
+        reporting = metrics.start(self.Metrics, SUMMARY, *self.MetricsAt)
+        try:
+            while not done:
+                self.Out.flush()
+                if self.ACKDeadline is not None:
+                    wait = max(0, self.ACKDeadline - time.time())
+                    if select.select([self.Sok], [], [], wait)[0] == []:
+                        self.sendACK() # delayed ACK timer expired
+                        continue
+                # Along with the first segment, take those queued behind.
+                for message, addr in self.In.read(True):
+                    if self.handle(message):
+                        done = True
+                        break
+        except KeyboardInterrupt:
+            self.checkpoint()
+            raise
+        finally:
+            metrics.stop(reporting)
         print('Delivery completed successfully. ')
+        if self.Verified is not None:
+            print('Integrity check passed. ' if self.Verified else \
+                  'Integrity check FAILED. ')
+
+    '''
+    Process one incoming message, whose checksum is checked unless the
+    caller did so already. Returns True once FIN is received.
+    '''
+    def handle(self, message, checked=False):
+        if not checked and not self.notCorrupt(message):
+            return False
+        flags = codec.decode(message)[4]
+        if flags & codec.SYN:
+            self.accept(message)
+            return False
+        if flags & codec.FIN:
+            self.finish(message)
+            return True
+        self.ackData(self.dealWithMess(message))
+        if self.Inflater is not None:
+            for payload in self.RecvBuffer:
+                data = self.Inflater.decompress(payload.tobytes())
+                self.Digest.update(data)
+                self.File.write(data)
+        else:
+            for payload in self.RecvBuffer:
+                self.Digest.update(payload)
+                self.File.write(payload)
+        self.RecvBuffer = []
+        if self.Positional and self.ExpOffset >= self.Hashed + DIGEST_CHUNK:
+            self._digestFile(self.ExpOffset)
+        if self.Advertised < min(self.MSS - 20, self.BufferSize // 2):
+            self.sendACK() # window update once data is written
+        if self.Checkpoint is not None and \
+           (self.ExpOffset >= self.Saved + CHECKPOINT_BYTES or \
+            time.time() >= self.SavedAt + CHECKPOINT_INTERVAL):
+            self.checkpoint()
+        return False
+
+    '''
+    Answer the SYN opening the connection, and every copy of it resent,
+    with the largest segment taken, the window and its scale. The MSS of
+    the connection is the smaller of both ends'. A resumable transfer
+    starts at the offset recorded for a stream of the length the first
+    SYN tells, which the SYN-ACK tells the sender to resume from. The
+    SYN-ACK accepts the compression the SYN offers if it can.
+    '''
+    def accept(self, message):
+        decode = codec.decode(message)
+        self.Log.write(time.time(), eventlog.IN | eventlog.SYN, decode[0], \
+                       decode[1], decode[2], decode[3])
+        options = codec.options(message, decode[4])
+        if 2 in options:
+            self.MSS = min(self.MaxMSS, codec.mssValue(options[2]))
+        if self.Checkpoint is not None and self.Length is None and \
+           codec.LENGTH in options:
+            self.Length = codec.experimentValue(options[codec.LENGTH])
+            self._start(self._resumeOffset())
+        self.Advertised = self._window()
+        reply = codec.mss(self.MaxMSS) + codec.windowScale(self.WindowShift)
+        if self.Checkpoint is not None:
+            # The sender digests from where it resumes, which is not 0
+            # when only it restarted: so does the digest here, from now.
+            self.Digest, self.Hashed = hashlib.sha256(), self.ExpOffset
+            reply += codec.experiment(codec.RESUME, self.ExpOffset)
+        elif not self.Positional and codec.COMPRESS in options and \
+             codec.experimentValue(options[codec.COMPRESS]) == codec.ZLIB:
+            if self.Inflater is None:
+                self.Inflater = zlib.decompressobj()
+            reply += codec.experiment(codec.COMPRESS, codec.ZLIB)
+        packet = codec.encode(self.LPort, self.ToPort, 0, self.ExpSeqNum, \
+                              codec.SYN | codec.ACK, \
+                              self.Advertised >> self.WindowShift, \
+                              options=reply, check=False)
+        self.Out.add(packet, (self.ToIP, self.ToPort))
+        self.Log.write(time.time(), eventlog.ACK | eventlog.SYN, self.LPort, \
+                       self.ToPort, 0, self.ExpSeqNum)
 
     '''
     Function for testing bit errors
     '''
     def notCorrupt(self, message):
-        calc = (message + '\x00') if len(message) % 2 != 0 else message
-        check = list(struct.unpack('!' + str(len(calc) // 2) + 'H', calc))
-        s = 0
-        while check != []:
-            s = self._add(s, check.pop(), 65535)
-        return s == 65535
+        return checksum.verify(message)
+
+    '''
+    Offset recorded in the checkpoint for a stream of Length bytes, down
+    to a whole block and to what the file holds; 0 without one.
+    '''
+    def _resumeOffset(self):
+        try:
+            f = open(self.Checkpoint)
+            fields = [int(field) for field in f.read().split()]
+            f.close()
+        except (IOError, ValueError):
+            return 0
+        if len(fields) != 2 or fields[0] != self.Length:
+            return 0
+        size = os.fstat(self.File.fileno()).st_size
+        return min(fields[1], size) // codec.UNIT * codec.UNIT
+
+    '''
+    Start the stream at offset: drop what the file holds beyond it and
+    expect the data there.
+    '''
+    def _start(self, offset):
+        self.File.truncate(offset)
+        self.File.seek(offset)
+        self.Hashed = offset # the prefix on disk is not read again
+        self.ExpOffset, self.ExpSeqNum = offset, offset & 0xFFFFFFFF
+        self.Saved = offset
+        if self.Positional:
+            self.UnackBuffer = BlockBitmap(codec.UNIT, offset)
+
+    '''
+    Record the data contiguous from the start of the stream in the
+    checkpoint once it is on disk. The checkpoint is replaced by a rename,
+    so that it is never found half written.
+    '''
+    def checkpoint(self):
+        if self.Checkpoint is None or self.Length is None or \
+           self.File.closed:
+            return
+        self.File.flush()
+        os.fsync(self.File.fileno())
+        f = open(self.Checkpoint + '.tmp', 'w')
+        f.write('%d %d\n' % (self.Length, self.ExpOffset))
+        f.close()
+        os.rename(self.Checkpoint + '.tmp', self.Checkpoint)
+        self.Saved, self.SavedAt = self.ExpOffset, time.time()
 
     '''
     Update RecvBuffer and UnackBuffer according to message received.
+    Returns whether it should be ACKed at once: when it is out of order,
+    a duplicate, fills a hole or is shorter than the largest segment yet.
     '''
     def dealWithMess(self, message):
-        decode = struct.unpack('!2H2I4H' + str(len(message) - 20) + 's', \
-                               message)
-        self.Record = [str(datetime.datetime.now()), \
-                       self.ToIP + ':' + str(decode[0]), \
-                       self.FromIP + ':' + str(decode[1]), \
-                       str(decode[2]), str(decode[3])]
-        self.Log.write(', '.join(self.Record) + '\n')
-        self.Record = []
-        head = decode[2] # SeqNum of the receiving packet
-        tail = self._add(decode[2], len(decode[-1])) # SeqNum of next packet
-        if self.ExpSeqNum == head: # Enqueue only if message is expected.
-            self.RecvBuffer.append(decode[-1])
-            self.ExpSeqNum = self._add(self.ExpSeqNum, len(decode[-1]))
-            while self.UnackBuffer != [] and \
-                  self.UnackBuffer[-1][1] == self.ExpSeqNum:
-                self.ExpSeqNum = self.UnackBuffer[-1][2]
-                self.RecvBuffer.append(self.UnackBuffer.pop()[0])
-        else:
-            self._insert([decode[-1], head, tail])
+        decode = codec.decode(message)
+        payload = codec.payload(message, decode[4])
+        self.Stat[0] += 1
+        self.Stat[1] += len(payload)
+        self.Largest = max(self.Largest, len(payload))
+        self.Log.write(time.time(), eventlog.IN, decode[0], decode[1], \
+                       decode[2], decode[3])
+        head = unwrap(decode[2], self.ExpOffset) # offset of the packet
+        tail = head + len(payload) # offset of next packet
+        if self.Positional:
+            return self._place(head, payload)
+        if head <= self.ExpOffset < tail: # Enqueue only if expected.
+            self.RecvBuffer.append(payload[self.ExpOffset - head:])
+            payloads, self.ExpOffset = self.UnackBuffer.drain(tail)
+            self.RecvBuffer.extend(payloads)
+            self.ExpSeqNum = self.ExpOffset & 0xFFFFFFFF
+            return payloads != [] or len(self.UnackBuffer) > 0 or \
+                   len(payload) < self.Largest
+        if head <= self.ExpOffset or \
+           tail > self.ExpOffset + self._window() or \
+           not self.UnackBuffer.insert(head, payload):
+            self.Stat[2] += 1 # duplicate or beyond the window
+        return True
+
+    '''
+    Write payload received at offset head in place and advance ExpOffset
+    over the blocks received. Returns whether it should be ACKed at once,
+    as dealWithMess does.
+    '''
+    def _place(self, head, payload):
+        tail = head + len(payload)
+        if head < self.ExpOffset or tail > self.ExpOffset + self._window() \
+           or not self.UnackBuffer.insert(head, len(payload)):
+            self.Stat[2] += 1
+            return True # duplicate, beyond the window or misaligned
+        self.File.seek(head)
+        self.File.write(payload)
+        if head > self.ExpOffset:
+            return True
+        self.ExpOffset = self.UnackBuffer.drain(self.ExpOffset)
+        self.ExpSeqNum = self.ExpOffset & 0xFFFFFFFF
+        # Any bit left in Mask is a block beyond a hole; counting them
+        # with len() costs a pass over the whole bitmap.
+        return self.ExpOffset > tail or self.UnackBuffer.Mask != 0 or \
+               len(payload) < self.Largest
+
+    '''
+    Free receive buffer space beyond ExpOffset, in bytes: what in-order
+    data waiting in RecvBuffer leaves. Out-of-order data already lies
+    within it.
+    '''
+    def _window(self):
+        pending = sum(len(payload) for payload in self.RecvBuffer)
+        return max(0, self.BufferSize - pending)
+
+    '''
+    ACK a data segment now or, with delayed ACKs, when it is the second
+    full in-order segment not ACKed yet or ACK_DELAY later at the latest.
+    '''
+    def ackData(self, immediate):
+        if not self.DelayedACK or immediate:
+            self.sendACK()
+            return
+        self.Unacked += 1
+        if self.Unacked >= 2:
+            self.sendACK()
+        elif self.ACKDeadline is None:
+            self.ACKDeadline = time.time() + ACK_DELAY
 
     '''
     Send ACK according to ExpSeqNum.
     '''
     def sendACK(self):
-        packet = struct.pack('!2H2I4H', \
-                             self.LPort, self.ToPort, \
-                             0, self.ExpSeqNum, \
-                             2 ** 4, 0, 0, 0)
-        self.Sok.sendto(packet, (self.ToIP, self.ToPort))
-        self.Record = [str(datetime.datetime.now()), \
-                       self.FromIP + ':' + str(self.LPort), \
-                       self.ToIP + ':' + str(self.ToPort), \
-                       str(0), str(self.ExpSeqNum), 'ACK']
-        self.Log.write(', '.join(self.Record) + '\n')
-        self.Record = []
+        self.Unacked, self.ACKDeadline = 0, None
+        self.Stat[3] += 1
+        self.Advertised = self._window()
+        # Every ACK carries the window scale option, not only the SYN-ACK.
+        options = codec.windowScale(self.WindowShift)
+        if self.SACK:
+            options += self._sackOption()
+        packet = codec.encode(self.LPort, self.ToPort, 0, self.ExpSeqNum, \
+                              codec.ACK, self.Advertised >> self.WindowShift, \
+                              options=options, check=False)
+        self.Out.add(packet, (self.ToIP, self.ToPort))
+        self.Log.write(time.time(), eventlog.ACK, self.LPort, self.ToPort, \
+                       0, self.ExpSeqNum)
+
+    '''
+    Build the SACK option out of the runs held in UnackBuffer, padded to
+    a multiple of 4 bytes.
+    '''
+    def _sackOption(self):
+        return codec.sack([[n & 0xFFFFFFFF for n in block] \
+                           for block in self.UnackBuffer.blocks(SACK_BLOCKS)])
 
     '''
     Send ACK if FIN is received and close the connection and files.
     '''
     def finish(self, message):
-        decode = struct.unpack('!2H2I4H', message)
-        self.Record = [str(datetime.datetime.now()), \
-                       self.ToIP + ':' + str(decode[0]), \
-                       self.FromIP + ':' + str(decode[1]), \
-                       str(decode[2]), str(decode[3]), 'FIN']
-        self.Log.write(', '.join(self.Record) + '\n')
-        self.Record = []
-        if decode[4] == 1: # Verify that FIN is received
-            packet = struct.pack('!2H2I4H', \
-                                 self.LPort, self.ToPort, \
-                                 0, self.ExpSeqNum, \
-                                 2 ** 4 + 1, 0, 0, 0)
-            self.Sok.sendto(packet, (self.ToIP, self.ToPort))
-            self.Record = [str(datetime.datetime.now()), \
-                           self.FromIP + ':' + str(self.LPort), \
-                           self.ToIP + ':' + str(self.ToPort), \
-                           str(0), str(self.ExpSeqNum), 'ACK', 'FIN']
-            self.Log.write(', '.join(self.Record) + '\n')
-            self.Record = []
+        decode = codec.decode(message)
+        self.Log.write(time.time(), eventlog.IN | eventlog.FIN, decode[0], \
+                       decode[1], decode[2], decode[3])
+        if decode[4] & 0x3F == codec.FIN: # Verify that FIN is received
+            if self.Inflater is not None:
+                data = self.Inflater.flush()
+                self.Digest.update(data)
+                self.File.write(data)
+            if self.Positional:
+                self._digestFile(self.ExpOffset)
+            digest = self.Digest.digest()
+            options = codec.options(message, decode[4])
+            if codec.DIGEST in options:
+                self.Verified = options[codec.DIGEST] == digest
+            self.FinOptions = codec.experimentData(codec.DIGEST, digest)
+            self.sendFinACK()
+            self.Log.write(time.time(), eventlog.ACK | eventlog.FIN, \
+                           self.LPort, self.ToPort, 0, self.ExpSeqNum)
             self.Log.close()
             self.File.close()
-            self.Sok.close()
+            if self.Checkpoint is not None and \
+               os.path.isfile(self.Checkpoint): # nothing left to resume
+                os.remove(self.Checkpoint)
+            if self.OwnSocket:
+                self.Sok.close()
+
+    '''
+    Feed the file from Hashed up to offset upTo to the digest, reading back
+    what was written in place or by the transfer resumed, and leave the
+    file at upTo.
+    '''
+    def _digestFile(self, upTo):
+        self.File.flush()
+        self.File.seek(self.Hashed)
+        while self.Hashed < upTo:
+            data = self.File.read(min(DIGEST_CHUNK, upTo - self.Hashed))
+            if not data:
+                break
+            self.Digest.update(data)
+            self.Hashed += len(data)
+        self.File.seek(upTo)
+
+    '''
+    Send the ACK of FIN, with the digest of the data written, also to FINs
+    resent once the connection is closed.
+    '''
+    def sendFinACK(self):
+        packet = codec.encode(self.LPort, self.ToPort, 0, self.ExpSeqNum, \
+                              codec.ACK | codec.FIN, options=self.FinOptions, \
+                              check=False)
+        self.Out.add(packet, (self.ToIP, self.ToPort))
+        self.Out.flush()
 
+class Server:
     '''
-    Fixed-length unsigned integer increment. The length is specified by
-    base
+    Receive any number of concurrent transfers on one port. Segments are
+    demultiplexed by their source IP and source port to a Receiver per
+    connection, all sharing one socket and one event loop, and the server
+    keeps running once they close. The file and log of a connection are
+    named after fileName and logName suffixed with its sender's IP and
+    port; the other keywords are passed on to every Receiver, but for
+    metricsInterval and metricsEndpoint: metrics are summed over all
+    connections, the closed ones included.
     '''
-    def _add(self, num, increment, base=0xFFFFFFFF):
-        num += increment
-        if num > base:
-            num -= (base + 1)
-        return num
+    def __init__(self, fileName, lPort, logName, **kw):
+        self.Sok = socket(AF_INET, SOCK_DGRAM)
+        self.Sok.bind(('', lPort))
+        self.Sok.setsockopt(SOL_SOCKET, SO_RCVBUF, \
+                            kw.get('bufferSize', BUFFER_SIZE))
+        self.In = batchio.Reader(self.Sok, kw.get('mss', codec.MAX_MSS), \
+                                 kw.get('mmsg', False))
+        self.FromIP = gethostbyname(gethostname())
+        self.FileName, self.LPort, self.LogName = fileName, lPort, logName
+        self.MetricsAt = (kw.pop('metricsInterval', None), \
+                          kw.pop('metricsEndpoint', None))
+        self.Options = kw
+        # Open connections, and closed ones with the time they closed,
+        # both keyed by (source IP, source port).
+        self.Connections, self.Closed = {}, {}
+        # Stat of connections closed LINGER ago, which Closed forgot.
+        self.Forgotten = [0, 0, 0, 0]
+        self.Metrics = metrics.Registry()
+        names = ['segments_received', 'bytes_received', \
+                 'segments_discarded', 'acks_sent']
+        for i in range(len(names)):
+            self.Metrics.counter(names[i], lambda i=i: self._total(i))
+        self.Metrics.gauge('connections', lambda: len(self.Connections))
+        self.Metrics.gauge('out_of_order_bytes', lambda: \
+                           sum(conn._outOfOrder() for conn in \
+                               list(self.Connections.values())))
+
+    '''
+    Item i of Stat summed over all connections.
+    '''
+    def _total(self, i):
+        conns = list(self.Connections.values()) + \
+                [v[0] for v in list(self.Closed.values())]
+        return self.Forgotten[i] + sum(conn.Stat[i] for conn in conns)
 
     '''
-    Insert Unexpected packet into UnackBuffer. Situation when sequence
-    number overflows is considered and dealt with.
+    The main server function, which never returns. Once interrupted, the
+    open connections save their checkpoints.
     '''
-    def _insert(self, seg):
-        ht = [self.ExpSeqNum] # Array for storing head-tail info
-        # Iterate to record head-tails and check duplicate packet
-        for count in range(len(self.UnackBuffer) - 1, -1, -1):
-            ht.append(self.UnackBuffer[count][1:])
-            if seg == self.UnackBuffer[count]:
+    def run(self):
+        metrics.start(self.Metrics, ['connections', 'bytes_received', \
+                                     'segments_discarded', \
+                                     'out_of_order_bytes'], *self.MetricsAt)
+        try:
+            self._serve()
+        except KeyboardInterrupt:
+            for conn in self.Connections.values():
+                conn.checkpoint()
+            raise
+
+    def _serve(self):
+        while True:
+            deadlines = [conn.ACKDeadline for conn in \
+                         self.Connections.values() \
+                         if conn.ACKDeadline is not None]
+            wait = max(0, min(deadlines) - time.time()) if deadlines else None
+            if select.select([self.Sok], [], [], wait)[0] != []:
+                for message, addr in self.In.read():
+                    self.dispatch(message, addr)
+            now = time.time()
+            for conn in self.Connections.values():
+                if conn.ACKDeadline is not None and conn.ACKDeadline <= now:
+                    conn.sendACK() # delayed ACK timer expired
+                conn.Out.flush()
+
+    '''
+    Hand message to the connection it belongs to, opening one for the SYN
+    of a new sender.
+    '''
+    def dispatch(self, message, addr):
+        if len(message) < codec.SIZE or not checksum.verify(message):
+            return
+        decode = codec.decode(message)
+        key = (addr[0], decode[0])
+        conn = self.Connections.get(key)
+        if conn is None:
+            if decode[4] & codec.FIN: # FIN resent after its ACK got lost
+                if key in self.Closed:
+                    self.Closed[key][0].sendFinACK()
                 return
-        head, tail = seg[1], seg[2]
-        if seg[1] > seg[2]: # If overflow happens in the packet recved
-            tail += 0xFFFFFFFF
-        rewind = False # Flag indicating whether rewind happens
-        # Update ht from the point where rewind happens.
-        if len(ht) > 1 and ht[0] > ht[1][0]:
-            rewind = True
-        for count in range(1, len(ht)):
-            if rewind:
-                ht[count][0] += 0xFFFFFFFF
-                ht[count][1] += 0xFFFFFFFF
-            else:
-                if ht[count][0] > ht[count][1]:
-                    ht[count][1] += 0xFFFFFFFF
-                    rewind = True
-                elif count < len(ht) - 1 and ht[count][1] > ht[count + 1][0]:
-                    rewind = True
-        # Insert segment to the proper position of UnackBuffer.
-        if len(ht) == 1 or ht[0] <= head and ht[1][0] >= tail:
-            self.UnackBuffer.append(seg)
-        else:
-            count = 1
-            while count < len(ht) - 1:
-                if ht[count][1] <= head and ht[count + 1][0] >= tail:
-                    self.UnackBuffer.insert(len(self.UnackBuffer) - count, \
-                                            seg)
-                    return
-                count += 1
-            self.UnackBuffer.insert(0, seg)
+            if not decode[4] & codec.SYN: # of no open connection
+                return
+            suffix = '.%s.%d' % key
+            conn = Receiver(self.FileName + suffix, self.LPort, key[0], \
+                            key[1], self.LogName + suffix, sok=self.Sok, \
+                            fromIP=self.FromIP, **self.Options)
+            self.Connections[key] = conn
+            self.Closed.pop(key, None)
+        if conn.handle(message, True):
+            del self.Connections[key]
+            now = time.time()
+            self.Closed[key] = [conn, now]
+            for k in [k for k, v in self.Closed.items() \
+                      if v[1] < now - LINGER]:
+                for i in range(len(self.Forgotten)):
+                    self.Forgotten[i] += self.Closed[k][0].Stat[i]
+                del self.Closed[k]
+            print('Delivery from %s:%d completed successfully. ' % key)
+            if conn.Verified is not None:
+                print('Integrity check of %s:%d %s. ' % \
+                      (key + ('passed' if conn.Verified else 'FAILED',)))
 
 
 if __name__ == '__main__':
-    para = sys.argv
-    if len(para) == 1:
-        r = Receiver('file_recv.txt', 41194, \
-                     'localhost', 41191, 'log_recv.txt')
-        r.run()
-        print filecmp.cmp('file_recv.txt', 'file_send.txt')
-    else:
-        r = Receiver(para[1], int(para[2]), para[3], int(para[4]), para[5])
-        r.run()
+    # Options may precede or follow the positional arguments:
+    #   -s      report out-of-order blocks with selective acknowledgments
+    #   -b      binary event log, render it with logdump.py
+    #   -n <N>  log one in N events, 0 for none but FIN-related ones
+    #   -d      delay ACKs of in-order segments, ACKing every second one
+    #   -w <B>  receive buffer size advertised to the sender, bytes
+    #   -p      write every segment in place, out-of-order ones included
+    #   -m      serve many senders, with arguments
+    #           <filename> <listening_port> <log_filename>
+    #   -M      batch system calls with sendmmsg and recvmmsg
+    #   -S <B>  largest segment taken, TCP header included, 65507 by default
+    #   -R      keep a checkpoint to resume an interrupted transfer from
+    #   -I <s>  print a summary line of live metrics to stderr every s
+    #           seconds
+    #   -E <addr> serve live metrics at a port of 127.0.0.1 over HTTP, or
+    #           at the path of a Unix socket
+    opts, args = getopt.gnu_getopt(sys.argv[1:], 'sbn:dw:pmMS:RI:E:')
+    para, kw, server = [sys.argv[0]] + args, {}, False
+    for opt, val in opts:
+        if opt == '-s':
+            kw['sack'] = True
+        elif opt == '-b':
+            kw['binaryLog'] = True
+        elif opt == '-n':
+            kw['logSample'] = int(val)
+        elif opt == '-d':
+            kw['delayedAck'] = True
+        elif opt == '-w':
+            kw['bufferSize'] = int(val)
+        elif opt == '-p':
+            kw['positional'] = True
+        elif opt == '-m':
+            server = True
+        elif opt == '-M':
+            kw['mmsg'] = True
+        elif opt == '-S':
+            kw['mss'] = int(val)
+        elif opt == '-R':
+            kw['resume'] = True
+        elif opt == '-I':
+            kw['metricsInterval'] = float(val)
+        elif opt == '-E':
+            kw['metricsEndpoint'] = val
+    signalled = [signal.SIGINT] # Ctrl-C, unless SIGTERM comes instead
+    def stop(signum, frame):
+        signalled[0] = signum
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop) # save checkpoints when terminated
+    try:
+        if server:
+            Server(para[1], int(para[2]), para[3], **kw).run()
+        elif len(para) == 1:
+            r = Receiver('file_recv.txt', 41194, \
+                         'localhost', 41191, 'log_recv.txt', **kw)
+            r.run()
+        else:
+            r = Receiver(para[1], int(para[2]), para[3], int(para[4]), \
+                         para[5], **kw)
+            r.run()
+    except KeyboardInterrupt: # checkpoints are saved, which is all to do
+        sys.exit(128 + signalled[0])
+    sys.exit(1 if r.Verified is False else 0)
@@ -7,251 +7,744 @@ __author__ = 'Sirui Tan'
 from socket import *
 import sys
 import pdb
+import getopt
+import select
 import threading
-import struct
 import time
-import datetime
+import heapq
+import collections
+import hashlib
+from segmenter import Segmenter, Deflater
+import congestion
+import pacing
+import codec
+import eventlog
+import metrics
+import batchio
+import reorder
 
 MSS = 532 # the maximum segment size here includes TCP header.
+# Losses in a row of probes of one size before it is taken as too big for
+# the path (RFC 8899), and the precision of the search, a fraction of the
+# segment size.
+MAX_PROBES, PROBE_PRECISION = 3, 32
+# Linux socket options: path MTU discovery and the MTU of a route.
+IP_MTU_DISCOVER, IP_PMTUDISC_PROBE, IP_MTU = 10, 3, 14
+ACK_SIZE = 60 # the largest ACK, a TCP header full of options.
+ACK_QUEUE = 4096 # most ACKs waiting for the main loop, oldest dropped
+MIN_RTO, MAX_RTO = 0.2, 60.0 # bounds of TimeoutInterval in seconds
+# Metrics in the summary line of the -I option.
+SUMMARY = ['bytes_acked', 'in_flight_bytes', 'cwnd_segments', \
+           'srtt_seconds', 'rto_seconds', 'retransmission_ratio', \
+           'rtt_seconds']
 
 class Sender:
-    def __init__(self, fileName, rIP, rPort, aPort, logName, windowSize):
+    def __init__(self, fileName, rIP, rPort, aPort, logName, windowSize, \
+                 engine='thread', cc='reno', sack=False, binaryLog=False, \
+                 logSample=1, start=0, length=None, mmsg=False, \
+                 pace=False, rate=None, burst=None, mss=MSS, probe=False, \
+                 metricsInterval=None, metricsEndpoint=None, compress=None):
         try:
-            self.SendBuffer = self._loadData(fileName)
+            # Only the byte range [start, start + length) of the file is
+            # sent, the whole file by default.
+            self.Segments = Segmenter(fileName, MSS - 20, start, length)
+            # With compress, a zlib level, the SYN offers to compress the
+            # stream; if the receiver accepts, Segments is replaced by a
+            # Deflater of it and Raw keeps the length of the original.
+            self.Compress, self.Raw = compress, None
+            # SHA-256 digest of the original stream, fed as segments leave
+            # for the first time, which the FIN carries for the receiver
+            # to check what it wrote against. A resumed transfer digests
+            # what it sends, from Resumed on. Verified is whether the
+            # FIN-ACK brought the same digest back, None if it brought none.
+            self.Digest, self.Verified = hashlib.sha256(), None
             self.Sok = socket(AF_INET, SOCK_DGRAM)
             self.Sok.bind(('', aPort))
+            # The largest segment to send, TCP header included. SegSize is
+            # the payload size the handshake agrees on with the receiver,
+            # None until then, and MaxSeg the largest one it allows.
+            self.MaxMSS = max(20 + codec.UNIT, min(mss, codec.MAX_MSS))
+            self.SegSize, self.MaxSeg = None, None
+            # With probe, segments start at MSS and grow while one probe
+            # at a time of a larger size gets through. ProbeCeil is the
+            # smallest size that failed and ProbeFails counts the losses
+            # of the current size. Datagrams too big then are not split
+            # into IP fragments but dropped.
+            self.Probing, self.Probe = probe, None
+            self.ProbeCeil, self.ProbeFails = None, 0
+            if probe:
+                try:
+                    self.Sok.setsockopt(IPPROTO_IP, IP_MTU_DISCOVER, \
+                                        IP_PMTUDISC_PROBE)
+                except error: # not on Linux
+                    pass
+            # Outgoing segments are queued in Out and leave in batches,
+            # incoming ACKs are all read at once. mmsg uses sendmmsg and
+            # recvmmsg for it.
+            self.Out = batchio.Writer(self.Sok, mmsg)
+            self.In = batchio.Reader(self.Sok, ACK_SIZE, mmsg)
             self.FromIP = gethostbyname(gethostname())
             self.FromPort, self.ToIP, self.ToPort = aPort, rIP, rPort
+            # windowSize caps the congestion window, or is the window
+            # itself for the 'fixed' algorithm.
             self.WindowSize = windowSize
-            self.RecvBuffer, self.UnackBuffer = [], []
-            self.Log = open(logName, 'w')
-            # At anytime except for UnackBuffer manipulation, UnackBuffer
-            # is always enclosed by SendBase and NextSeqNum.
-            self.NextSeqNum, self.SendBase = 0, 0
-            self.Timer, self.TimeoutInterval = None, 1.0
+            self.CC = congestion.create(cc, windowSize)
+            # With pace, segments are spread over the RTT; rate caps the
+            # sending rate in bytes per second by a token bucket of burst
+            # bytes.
+            self.Pacer = pacing.Pacer(pace, rate, burst)
+            # RecvBuffer hands (ACK, arrival time) pairs over from recvACK
+            # or _poll to the main loop. One thread appends and the other
+            # pops, which a deque does atomically without a lock.
+            self.RecvBuffer = collections.deque(maxlen=ACK_QUEUE)
+            self.UnackBuffer = []
+            self.Log = eventlog.openLog(logName, self.FromIP, rIP, \
+                                        binaryLog, logSample)
+            # Unwrapped byte offsets of the first unACKed byte, of the next
+            # segment and of where the receiver had the stream up to when
+            # it started. Sequence numbers only wrap on the wire: ACK
+            # numbers are unwrapped against SendBase, and UnackBuffer is
+            # always enclosed by SendBase and NextOffset except while
+            # being manipulated.
+            self.SendBase, self.NextOffset, self.Resumed = 0, 0, 0
+            # Every segment in flight has its own deadline. Timers is a
+            # heap of [deadline, serial, entry] where an item is stale once
+            # the deadline stored in the entry differs. After a timeout no
+            # other segment may expire before TimerFloor.
+            self.Timers, self.TimerSerial, self.TimerFloor = [], 0, 0
+            # NextOffset when the first segment last timed out, until an
+            # ACK covers it; None otherwise.
+            self.Recover = None
+            self.TimeoutInterval = 1.0
             self.EstimatedRTT, self.SampleRTT, self.DevRTT = 0, 0, 0
-            self.Stat, self.Record = [0, 0, 0], []
+            # Bytes sent, segments sent, segments retransmitted and, among
+            # the latter, fast retransmissions.
+            self.Stat = [0, 0, 0, 0]
+            self.DupACKs = 0 # Duplicates of the ACK for SendBase
+            # Receive window advertised by the last ACK, in bytes. While it
+            # is too small for the next segment and nothing is in flight,
+            # a probe is sent at PersistDeadline, backing off each time.
+            self.RcvWindow = 65535
+            self.PersistDeadline, self.PersistBackoff = None, 0
+            # UnackBuffer entries are [packet, offset, send time, SACKed,
+            # resent in current recovery, ever resent, deadline]. With
+            # SACK only the holes in the receiver's buffer are resent.
+            self.SACK = sack
+            # 'thread' polls buffers filled by recvACK, 'event' blocks in
+            # select() until an ACK arrives or the timer expires.
+            self.Engine = engine
+            # Live metrics, summarized on stderr every metricsInterval
+            # seconds and served at metricsEndpoint if given.
+            self.Metrics = metrics.Registry()
+            self.MetricsAt = (metricsInterval, metricsEndpoint)
+            self._register()
         except IOError:
             print('File to be sent not found, terminating...')
             exit()
 
-    def _loadData(self, fileName):
-        f = open(fileName, 'r')
-        sB = []
-        while True:
-            segment = f.read(MSS - 20)
-            if segment == '':
-                break
-            else:
-                sB.append(segment)
-        f.close()
-        return sB
-
     '''
     The main sender function.
     '''
     def run(self):
-        r = threading.Thread(target=self.recvACK, args=())
-        r.daemon = True
-        r.start()
+        if self.Engine == 'event':
+            self.Sok.setblocking(False)
+        else:
+            r = threading.Thread(target=self.recvACK, args=())
+            r.daemon = True
+            r.start()
+        reporting = metrics.start(self.Metrics, SUMMARY, *self.MetricsAt)
+        self.connect()
         while True: # Main loop
-            # Deal with ACKs as long as there are any incoming
-            if self.RecvBuffer != []:
-                while self.RecvBuffer != []:
-                    self.dealWithUnack()
-            if self.isTimeout():
-                self.retransmit()
-            if self.SendBuffer != [] and \
-               len(self.UnackBuffer) != self.WindowSize:
-                self.sendOutPacket()
-            # Both buffers are empty means all packets are ACKed
-            if self.SendBuffer == [] and self.UnackBuffer == []:
+            # Both buffers are empty means all packets are ACKed, which
+            # is checked before waiting, as no ACK would come then.
+            if not self.Segments.hasMore(self.NextOffset) and \
+               self.UnackBuffer == []:
                 self.finish()
                 break
+            # Before waiting, so that a window too small for the first
+            # segment, as the SYN-ACK may advertise, is probed too.
+            self._checkPersist()
+            self._poll()
+            if self.RecvBuffer: # all the ACKs received since last time
+                self.dealWithACKs()
+            if self.isTimeout():
+                self.retransmit(heapq.heappop(self.Timers)[2])
+            while self._canSend(): # a burst of what the windows allow
+                self.sendOutPacket()
+        metrics.stop(reporting)
         print('Delivery completed successfully. ')
+        if self.Resumed > 0:
+            print('Resumed from byte ' + str(self.Resumed))
+        if self.Raw is not None:
+            print('Stream compressed from %d to %d bytes' % \
+                  (self.Raw, self.Segments.Length))
+        if self.Verified is not None:
+            print('Integrity check passed. ' if self.Verified else \
+                  'Integrity check FAILED. ')
         print('Total bytes sent = ' + str(self.Stat[0]))
         print('Segments sent = ' + str(self.Stat[1]))
         print('Segments retransmitted = ' + str(self.Stat[2]))
+        print('Segments fast retransmitted = ' + str(self.Stat[3]))
+
+    '''
+    Register the metrics of the transfer. All but the RTT histogram read
+    the state kept for the transfer when a snapshot is taken.
+    '''
+    def _register(self):
+        m, stat = self.Metrics, self.Stat
+        m.counter('bytes_sent', lambda: stat[0])
+        m.counter('segments_sent', lambda: stat[1])
+        m.counter('segments_retransmitted', lambda: stat[2])
+        m.counter('segments_fast_retransmitted', lambda: stat[3])
+        m.counter('bytes_acked', lambda: self.NextOffset - self.Resumed - \
+                  self._inFlight())
+        m.gauge('in_flight_bytes', self._inFlight)
+        m.gauge('in_flight_segments', lambda: len(self.UnackBuffer))
+        m.gauge('cwnd_segments', lambda: self.CC.Cwnd)
+        m.gauge('receive_window_bytes', lambda: self.RcvWindow)
+        m.gauge('segment_bytes', lambda: self.SegSize or 0)
+        m.gauge('srtt_seconds', lambda: self.EstimatedRTT)
+        m.gauge('rttvar_seconds', lambda: self.DevRTT)
+        m.gauge('rto_seconds', lambda: self.TimeoutInterval)
+        m.gauge('retransmission_ratio', \
+                lambda: stat[2] / float(max(1, stat[1])))
+        self.RTTs = m.histogram('rtt_seconds')
+
+    def _inFlight(self):
+        return self.NextOffset - self.SendBase
+
+    '''
+    Open the connection: send SYN with the MSS option and the length of
+    the stream until a SYN-ACK answers, then take the smaller MSS of both
+    ends, the receive window, the offset to resume from if the receiver
+    has the stream up to there, and a first RTT sample from the latter.
+    If the SYN offered compression and the SYN-ACK accepts it, the stream
+    is then compressed as it is sent. The SYN takes no sequence number.
+    '''
+    def connect(self):
+        options = codec.mss(self.MaxMSS) + \
+                  codec.experiment(codec.LENGTH, self.Segments.Length)
+        if self.Compress is not None:
+            options += codec.experiment(codec.COMPRESS, codec.ZLIB)
+        SYN = codec.encode(self.FromPort, self.ToPort, 0, 0, codec.SYN, \
+                           options=options)
+        self._sendPak(SYN, 0, eventlog.SYN)
+        # The SYN is timed like a segment, without joining UnackBuffer.
+        entry = [SYN, 0, time.time(), False, False, False, None]
+        self._arm(entry)
+        while self.SegSize is None:
+            self._poll()
+            if self.isTimeout(): # Resend SYN
+                heapq.heappop(self.Timers)
+                self.TimeoutInterval = min(2 * self.TimeoutInterval, MAX_RTO)
+                self._sendPak(SYN, 0, eventlog.SYN)
+                self.Stat[2] += 1
+                entry[5] = True
+                self._arm(entry)
+            while self.RecvBuffer and self.SegSize is None:
+                ACK = self.RecvBuffer.popleft()
+                decode = codec.decode(ACK[0])
+                if decode[4] & 0x3F != codec.SYN | codec.ACK:
+                    continue
+                self.Log.write(ACK[1], eventlog.IN | eventlog.ACK | \
+                               eventlog.SYN, decode[0], decode[1], \
+                               decode[2], decode[3], self.EstimatedRTT, \
+                               self.CC.Cwnd)
+                options = codec.options(ACK[0], decode[4])
+                self._updateWindow(decode[5], options)
+                mss = self.MaxMSS
+                if 2 in options:
+                    mss = min(mss, codec.mssValue(options[2]))
+                self.MaxSeg = (mss - 20) // codec.UNIT * codec.UNIT
+                self.SegSize = self.MaxSeg
+                self.Pacer.fit(self.MaxSeg + 20)
+                if self.Probing:
+                    self.SegSize = min(self.MaxSeg, MSS - 20)
+                if codec.RESUME in options: # the prefix is not read again
+                    self.NextOffset = min(self.Segments.Length, \
+                        codec.experimentValue(options[codec.RESUME]))
+                    self.SendBase = self.NextOffset
+                    self.Resumed = self.NextOffset
+                entry[6] = None # cancel its timer
+                if not entry[5]:
+                    self.SampleRTT = ACK[1] - entry[2]
+                    self._update()
+                if self.Compress is not None and \
+                   codec.COMPRESS in options and codec.experimentValue( \
+                       options[codec.COMPRESS]) == codec.ZLIB:
+                    self.Raw = self.Segments.Length
+                    self.Segments = Deflater(self.Segments, self.Compress, \
+                                             self.Digest)
 
     '''
     Daemon thread responsible for storing incoming ACKs to RecvBuffer
     '''
     def recvACK(self):
         while True:
-            message, addr = self.Sok.recvfrom(20)
+            batch = self.In.read(True)
             # ACK's receving time is recorded along with the ACK itself.
-            self.RecvBuffer.append([message, str(datetime.datetime.now()), \
-                                    time.time()])
-
-    '''
-    Manipulate on UnackBuffer according to the earliest received ACK.
-    '''
-    def dealWithUnack(self):
-        ACK = self.RecvBuffer.pop(0) # Dequeue the earlist received ACK
-        decode = struct.unpack('!2H2I4H', ACK[0])
-        # Record incoming ACK on log file.
-        self.Record = [ACK[1], \
-                       self.ToIP + ':' + str(decode[0]), \
-                       self.FromIP + ':' + str(decode[1]), \
-                       str(decode[2]), str(decode[3]), \
-                       'ACK', str(self.EstimatedRTT)]
-        self.Log.write(', '.join(self.Record) + '\n')
-        self.Record = []
+            now = time.time()
+            for message, addr in batch:
+                self.RecvBuffer.append((message, now))
+
+    '''
+    Send the segments queued since the last call, then wait for the next
+    event of the event-driven engine: block until an ACK is readable or
+    the retransmission timer expires, then move every pending ACK to
+    RecvBuffer. Returns at once if there is data to send. Does not wait
+    for the threaded engine, whose recvACK fills RecvBuffer.
+    '''
+    def _poll(self):
+        self.Out.flush()
+        if self.Engine != 'event':
+            return
+        readable = select.select([self.Sok], [], [], self._waitTime())[0]
+        while readable:
+            batch = self.In.read()
+            now = time.time()
+            for message, addr in batch:
+                self.RecvBuffer.append((message, now))
+            readable = len(batch) == batchio.BATCH
+
+    '''
+    Whether the next segment may leave now: the windows let it and the
+    pacer does not hold it back.
+    '''
+    def _canSend(self):
+        return self._windowOpen() and \
+               self.Pacer.wait(self._nextSize() + 20, time.time()) == 0
+
+    '''
+    Whether there is data left and room for it in both the congestion
+    window and the receive window, or a zero window probe is due.
+    '''
+    def _windowOpen(self):
+        if self.SegSize is None or not self.Segments.hasMore(self.NextOffset):
+            return False
+        if self.PersistDeadline is not None:
+            return time.time() >= self.PersistDeadline
+        return len(self.UnackBuffer) < self.CC.window() and \
+               self._inFlight() + self._nextSize() <= self.RcvWindow
+
+    '''
+    Payload bytes of the segment at NextOffset: a probe when one is due
+    and there is enough data left for it, SegSize at most otherwise.
+    '''
+    def _nextSize(self):
+        probe = self._probeSize()
+        if probe is not None and \
+           self.Segments.size(self.NextOffset, probe) == probe:
+            return probe
+        return self.Segments.size(self.NextOffset, self.SegSize)
+
+    '''
+    Payload bytes of the next probe, None if no probe is due: one probe is
+    in flight at a time and none during loss recovery. The size doubles
+    until a probe size fails, then the gap to the smallest size that
+    failed is halved until it is within 1 / PROBE_PRECISION of SegSize.
+    '''
+    def _probeSize(self):
+        if not self.Probing or self.Probe is not None or \
+           self.CC.InRecovery or self.Recover is not None:
+            return None
+        if self.ProbeCeil is None:
+            high, size = self.MaxSeg + codec.UNIT, 2 * self.SegSize
+        else:
+            high = self.ProbeCeil
+            size = (self.SegSize + self.ProbeCeil) // 2
+        if high - self.SegSize <= max(codec.UNIT, \
+                                      self.SegSize // PROBE_PRECISION):
+            return None
+        return min(self.MaxSeg, size // codec.UNIT * codec.UNIT)
+
+    '''
+    A probe was lost, which the resent data must not be again. Its size
+    is taken as too big once MAX_PROBES probes of it were lost in a row.
+    The data goes again in segments of SegSize, which replace the probe in
+    UnackBuffer.
+    '''
+    def _probeLost(self, entry, fast):
+        size = len(entry[0]) - 20
+        self.Probe, self.ProbeFails = None, self.ProbeFails + 1
+        if self.ProbeFails >= MAX_PROBES:
+            self.ProbeCeil, self.ProbeFails = size, 0
+        entry[6] = None # cancel its timer
+        payload, pieces = memoryview(entry[0])[20:], []
+        for start in range(0, size, self.SegSize):
+            seq = entry[1] + start
+            packet = codec.encode(self.FromPort, self.ToPort, \
+                                  seq & 0xFFFFFFFF, 0, 0, \
+                                  payload=payload[start:start + self.SegSize])
+            piece = [packet, seq, time.time(), False, True, True, None]
+            self._sendPak(packet, seq)
+            self.Stat[2] += 1
+            if fast:
+                self.Stat[3] += 1
+            self._arm(piece)
+            pieces.append(piece)
+        for at in range(len(self.UnackBuffer)):
+            if self.UnackBuffer[at] is entry:
+                self.UnackBuffer[at:at + 1] = pieces
+                break
+
+    '''
+    Start the persist timer when the receive window keeps the next segment
+    from leaving while nothing is in flight, since then no ACK would ever
+    reopen it. Stop it once the window opens.
+    '''
+    def _checkPersist(self):
+        if self.UnackBuffer == [] and self.Segments.hasMore(self.NextOffset) \
+           and self._nextSize() > self.RcvWindow:
+            if self.PersistDeadline is None:
+                self.PersistDeadline = time.time() + min(MAX_RTO, \
+                    self.TimeoutInterval * 2 ** self.PersistBackoff)
+        else:
+            self.PersistDeadline = None
+
+    '''
+    Seconds until the main loop has something to do, None if only an
+    incoming ACK can wake it up.
+    '''
+    def _waitTime(self):
+        deadline = self._nextDeadline()
+        if self.PersistDeadline is not None:
+            deadline = min(deadline or self.PersistDeadline, \
+                           self.PersistDeadline)
+        if self._windowOpen(): # only the pacer may hold the segment back
+            now = time.time()
+            paced = now + self.Pacer.wait(self._nextSize() + 20, now)
+            deadline = min(deadline or paced, paced)
+        if deadline is None:
+            return None
+        return max(0, deadline - time.time())
+
+    '''
+    Deal with the ACKs in RecvBuffer as one batch. Those before the first
+    carrying the highest cumulative ACK number of the batch are superseded
+    by it, so they are only logged: UnackBuffer is cleared up to it at
+    once. It and the ones behind it, duplicates among them, are dealt with
+    one by one.
+    '''
+    def dealWithACKs(self):
+        batch = []
+        while self.RecvBuffer:
+            ACK = self.RecvBuffer.popleft()
+            batch.append((ACK, codec.decode(ACK[0])))
+        first, highest = 0, self.SendBase
+        for i in range(len(batch)):
+            decode = batch[i][1]
+            ACKNum = reorder.unwrap(decode[3], self.SendBase)
+            if ACKNum > highest and not decode[4] & codec.SYN:
+                first, highest = i, ACKNum
+        for ACK, decode in batch[:first]:
+            self._logACK(ACK, decode)
+        for ACK, decode in batch[first:]:
+            self.dealWithUnack(ACK, decode)
+
+    def _logACK(self, ACK, decode):
+        self.Log.write(ACK[1], eventlog.IN | eventlog.ACK, decode[0], \
+                       decode[1], decode[2], decode[3], self.EstimatedRTT, \
+                       self.CC.Cwnd)
+
+    '''
+    Manipulate on UnackBuffer according to ACK, an (ACK, arrival time)
+    pair, whose header is decode. Its ACK number is unwrapped against
+    SendBase.
+    '''
+    def dealWithUnack(self, ACK, decode):
+        if decode[4] & codec.SYN: # a late answer to a resent SYN
+            return
+        self._logACK(ACK, decode) # Record incoming ACK on log file.
+        options, window = codec.options(ACK[0], decode[4]), self.RcvWindow
+        ACKNum = reorder.unwrap(decode[3], self.SendBase)
+        if ACKNum >= self.SendBase: # not an outdated ACK
+            self._updateWindow(decode[5], options)
         # Manipulate UnackBuffer only if received ACK number > SendBase.
-        if decode[3] > self.SendBase:
-            self.SendBase = decode[3]
+        if ACKNum > self.SendBase:
+            self.SendBase = ACKNum
+            acked, sample, resent = 0, None, False
             while self.UnackBuffer != [] and \
                   self.UnackBuffer[0][1] < self.SendBase:
-                self.SampleRTT = ACK[2] - self.UnackBuffer.pop(0)[2]
-            self._update() # update related time variables
-            if self.UnackBuffer == []:
-                self.Timer = None
-            else: # restart the timer
-                self.Timer = time.time()
+                entry = self.UnackBuffer.pop(0)
+                entry[6] = None # cancel its timer
+                if entry is self.Probe: # it fits the path, so go on with it
+                    self.SegSize = len(entry[0]) - 20
+                    self.Probe, self.ProbeFails = None, 0
+                acked += 1
+                resent = resent or entry[5]
+                if not entry[3]: # One SACKed earlier would inflate it
+                    sample = ACK[1] - entry[2]
+            self.TimerFloor = 0 # The timeout is over once data is ACKed
+            # Karn's rule: an ACK covering a resent segment is ambiguous,
+            # and the segments it covers besides were held up by the hole.
+            if sample is not None and not resent:
+                self.SampleRTT = sample
+                self._update() # update related time variables
+            self.DupACKs = 0
+            if self.CC.InRecovery:
+                self.CC.exitRecovery()
+                for entry in self.UnackBuffer:
+                    entry[4] = False
+            else:
+                self.CC.onAck(acked, self.SampleRTT, ACK[1])
+            if self.SACK:
+                self._markSacked(options)
+            if self.Recover is not None:
+                self.retransmitAfterTimeout()
+        elif ACKNum == self.SendBase and self.UnackBuffer != [] and \
+             self.RcvWindow == window: # window updates are not duplicates
+            if self.SACK:
+                self._markSacked(options)
+            # Three duplicates mean the segment at SendBase is lost while
+            # later ones still arrive, so resend it without waiting. Those
+            # of segments resent after a timeout are no news (RFC 6582).
+            self.DupACKs += 1
+            if self.DupACKs == 3 and self.UnackBuffer[0] is self.Probe:
+                self._resend(self.Probe, True) # too big, not congestion
+            elif self.DupACKs == 3 and self.Recover is None:
+                self.CC.enterRecovery(len(self.UnackBuffer))
+                if self.SACK:
+                    self.retransmitHoles()
+                else:
+                    self._resend(self.UnackBuffer[0], True)
+            elif self.DupACKs > 3 and self.CC.InRecovery:
+                self.CC.onDupAck()
+                if self.SACK: # SACK blocks may have revealed new holes
+                    self.retransmitHoles()
+
+    '''
+    Take the receive window of an ACK, scaled by its window scale option
+    (kind 3), and reset the persist backoff once it opens.
+    '''
+    def _updateWindow(self, window, options):
+        shift = ord(options[3][:1]) if 3 in options else 0
+        self.RcvWindow = window << min(shift, 14)
+        if self.RcvWindow > 0:
+            self.PersistBackoff = 0
 
     '''
-    Send out the first packet in SendBuffer.
+    Mark the UnackBuffer entries covered by the SACK option (kind 5) as
+    held by the receiver.
+    '''
+    def _markSacked(self, options):
+        for left, right in codec.sackBlocks(options.get(5, b'')):
+            span = (right - left) & 0xFFFFFFFF
+            for entry in self.UnackBuffer:
+                # Wrap-safe test of [seq, seq + len) within [left, right)
+                if ((entry[1] - left) & 0xFFFFFFFF) + len(entry[0]) - 20 \
+                   <= span:
+                    entry[3] = True
+                    entry[6] = None # the receiver has it, no more timer
+
+    '''
+    Send out the segment at NextOffset.
     '''
     def sendOutPacket(self):
-        packet = self._format() # Format segments into TCP packets
-        if self.Timer == None:
-            self.Timer = time.time()
-        self._sendPak(packet) # Send out data packet
-        # Update UnackBuffer and NextSeqNum
-        self.UnackBuffer.append([packet, self.NextSeqNum, time.time()])
-        self.NextSeqNum = self._add(self.NextSeqNum, len(packet) - 20)
-
-    '''
-    Retransmit the first packet in UnackBuffer and update timer. Note
-    here the delayed ACK is ignored.
-    '''
-    def retransmit(self):
-        packet = self.UnackBuffer[0][0]
-        self.Record = [self.FromIP + ':' + str(self.FromPort), \
-                       self.ToIP + ':' + str(self.ToPort), \
-                       str(self.UnackBuffer[0][1]), str(0)]
+        if self.PersistDeadline is not None: # this is a window probe
+            self.PersistDeadline = None
+            self.PersistBackoff += 1
+        # Format segments into TCP packets
+        size = self._nextSize()
+        packet = self._format(size)
+        if self.Raw is None: # the Deflater digests the original stream
+            self.Digest.update(self.Segments.get(self.NextOffset, size))
+        self._sendPak(packet, self.NextOffset) # Send out data packet
+        # Update UnackBuffer and NextOffset
+        entry = [packet, self.NextOffset, time.time(), False, False, False, \
+                 None]
+        self.UnackBuffer.append(entry)
+        if len(packet) - 20 > self.SegSize:
+            self.Probe = entry
+        self._arm(entry)
+        self.NextOffset += len(packet) - 20
+
+    '''
+    Deal with the UnackBuffer entry whose timer expired. For the first
+    segment this is a retransmission timeout: the timeout is doubled until
+    a new RTT sample arrives and other segments in flight get at least
+    that long before they may expire in turn. A later segment is only
+    resent if SACK tells it is a hole, since with cumulative ACKs alone
+    the receiver may well hold it. A probe that expired was too big for
+    the path, which says nothing about congestion (RFC 4821).
+    '''
+    def retransmit(self, entry):
+        if entry is self.Probe: # too big for the path, not congestion
+            self._resend(entry, False)
+        elif entry is self.UnackBuffer[0]:
+            self.CC.onTimeout(len(self.UnackBuffer))
+            self.TimeoutInterval = min(2 * self.TimeoutInterval, MAX_RTO)
+            self.TimerFloor = time.time() + self.TimeoutInterval
+            self.Recover = self.NextOffset
+            for other in self.UnackBuffer:
+                other[4] = False
+            self._resend(entry, False)
+            entry[4] = True
+        elif self.SACK:
+            self._resend(entry, False)
+        else:
+            self._arm(entry)
+
+    '''
+    After a timeout every segment sent before it is taken as lost, as a
+    whole window is often lost at once: each new ACK below Recover resends
+    the next segments not resent yet nor SACKed, as many as the congestion
+    window allows, instead of letting each of them time out in turn.
+    '''
+    def retransmitAfterTimeout(self):
+        if self.SendBase >= self.Recover or self.UnackBuffer == []:
+            self.Recover = None
+            for entry in self.UnackBuffer:
+                entry[4] = False
+            return
+        resent = len([entry for entry in self.UnackBuffer if entry[4]])
+        for entry in self.UnackBuffer:
+            if resent >= self.CC.window() or entry[1] >= self.Recover:
+                break
+            if not entry[3] and not entry[4]:
+                self._resend(entry, False)
+                entry[4] = True
+                resent += 1
+
+    '''
+    Selective repeat during fast recovery: resend, once per recovery,
+    every segment the receiver lacks although at least three later ones
+    were SACKed (RFC 6675), so mere reordering is not taken for loss.
+    The first segment always counts as lost here.
+    '''
+    def retransmitHoles(self):
+        lost, sackedAbove = [], 0
+        for count in range(len(self.UnackBuffer) - 1, -1, -1):
+            entry = self.UnackBuffer[count]
+            if entry[3]:
+                sackedAbove += 1
+            elif not entry[4] and (sackedAbove >= 3 or count == 0):
+                lost.append(entry)
+        for entry in reversed(lost):
+            self._resend(entry, True)
+            entry[4] = True
+
+    '''
+    Resend the packet of an UnackBuffer entry and restart its timer.
+    '''
+    def _resend(self, entry, fast):
+        if entry is self.Probe:
+            self._probeLost(entry, fast)
+            return
         # There will be overlap between send and retrans counts
-        self._sendPak(packet)
+        self._sendPak(entry[0], entry[1])
         self.Stat[2] += 1
-        self.Timer = time.time()
-        # Following the GBN paradigm to update all unacked packets' timers
-        for count in range(len(self.UnackBuffer)):
-            self.UnackBuffer[count][2] = self.Timer
+        if fast:
+            self.Stat[3] += 1
+        entry[2], entry[5] = time.time(), True
+        self._arm(entry)
+
+    '''
+    Start (or restart) the timer of an entry, TimeoutInterval from now.
+    '''
+    def _arm(self, entry):
+        entry[6] = time.time() + self.TimeoutInterval
+        self.TimerSerial += 1
+        heapq.heappush(self.Timers, [entry[6], self.TimerSerial, entry])
+
+    '''
+    Earliest deadline of the running timers, None if there is none. Stale
+    heap items are dropped, and deadlines before TimerFloor postponed.
+    '''
+    def _nextDeadline(self):
+        while self.Timers != []:
+            deadline, serial, entry = self.Timers[0]
+            if entry[6] != deadline: # cancelled or restarted since
+                heapq.heappop(self.Timers)
+            elif deadline < self.TimerFloor:
+                item = heapq.heappop(self.Timers)
+                item[0] = entry[6] = self.TimerFloor
+                heapq.heappush(self.Timers, item)
+            else:
+                return deadline
+        return None
 
     '''
-    Function for checking timeout
+    Function for checking timeout. If it returns True, the expired entry
+    is the first item of Timers.
     '''
     def isTimeout(self):
-        if self.Timer == None:
-            return False
-        else:
-            return time.time() - self.Timer > self.TimeoutInterval
+        deadline = self._nextDeadline()
+        return deadline is not None and time.time() >= deadline
 
     '''
     Terminate connection when all packets are sent and ACKed.
     '''
     def finish(self):
-        # Send out the first FIN
-        output = struct.pack('!2H2I3H', \
-                             self.FromPort, self.ToPort, \
-                             self.NextSeqNum, 0, \
-                             1, 0, 0)
-        nums = struct.unpack('!' + str(len(output) // 2) + 'H', output)
-        checkSum = self._gene(list(nums))
-        FIN =  struct.pack('!2H2I4H', \
-                           self.FromPort, self.ToPort, \
-                           self.NextSeqNum, 0, \
-                           1, 0, checkSum, 0)
-        self.Record = [self.FromIP + ':' + str(self.FromPort), \
-                       self.ToIP + ':' + str(self.ToPort), \
-                       str(self.NextSeqNum), str(0), 'FIN']
-        self._sendPak(FIN)
-        self.Timer = time.time()
-        while True:
+        # Send out the first FIN, with the digest of the stream
+        digest = self.Digest.digest()
+        FIN = codec.encode(self.FromPort, self.ToPort, \
+                           self.NextOffset & 0xFFFFFFFF, 0, codec.FIN, \
+                           options=codec.experimentData(codec.DIGEST, digest))
+        self._sendPak(FIN, self.NextOffset, eventlog.FIN)
+        # The FIN is timed like a segment, without joining UnackBuffer.
+        self._arm([FIN, self.NextOffset, time.time(), False, False, True, \
+                   None])
+        done = False
+        while not done:
+            self._poll()
             # Resend FIN if timeout
-            if self.isTimeout(): # TimeoutInterval will no longer update
-                self.Record = [self.FromIP + ':' + str(self.FromPort), \
-                               self.ToIP + ':' + str(self.ToPort), \
-                               str(self.NextSeqNum), str(0), 'FIN']
-                self._sendPak(FIN)
+            if self.isTimeout():
+                heapq.heappop(self.Timers)
+                self.TimeoutInterval = min(2 * self.TimeoutInterval, MAX_RTO)
+                self._sendPak(FIN, self.NextOffset, eventlog.FIN)
                 self.Stat[2] += 1
-                self.Timer = time.time()
-            if self.RecvBuffer != []:
-                ACK = self.RecvBuffer.pop() # would expect only one ACK
-                decode = struct.unpack('!2H2I4H', ACK[0])
-                if decode[4] == 2 ** 4 + 1: # Validate incoming ACK
-                    self.Record = [ACK[1], \
-                                   self.ToIP + ':' + str(decode[0]), \
-                                   self.FromIP + ':' + str(decode[1]), \
-                                   str(decode[2]), str(decode[3]), \
-                                   'ACK', 'FIN', \
-                                   str(self.EstimatedRTT)]
-                    self.Log.write(', '.join(self.Record) + '\n')
-                    self.Record = []
+                self._arm([FIN, self.NextOffset, time.time(), False, False, \
+                           True, None])
+            while self.RecvBuffer and not done:
+                ACK = self.RecvBuffer.popleft() # late ACKs of data too
+                decode = codec.decode(ACK[0])
+                # Validate incoming ACK, ignoring the data offset
+                if decode[4] & 0x3F == codec.ACK | codec.FIN:
+                    self.Log.write(ACK[1], eventlog.IN | eventlog.ACK | \
+                                   eventlog.FIN, decode[0], decode[1], \
+                                   decode[2], decode[3], self.EstimatedRTT, \
+                                   self.CC.Cwnd)
+                    # The receiver's digest of what it wrote comes back.
+                    options = codec.options(ACK[0], decode[4])
+                    if codec.DIGEST in options:
+                        self.Verified = options[codec.DIGEST] == digest
                     self.Sok.close()
                     self.Log.close()
-                    break
-
-    '''
-    Generate TCP-styled packet out of original segment.
-    '''
-    def _format(self):
-        packet = self.SendBuffer.pop(0)
-        # Use separate string ref for generating checksum in case of 
-        # odd-lengthed packet
-        calc = (packet + '\x00') if len(packet) % 2 != 0 else packet
-        output = struct.pack('!2H2I3H' + str(len(calc)) + 's', \
-                             self.FromPort, self.ToPort, \
-                             self.NextSeqNum, 0, \
-                             0, 0, 0, \
-                             calc)
-        nums = struct.unpack('!' + str(len(output) // 2) + 'H', output)
-        checkSum = self._gene(list(nums)) # calculate checkSum
-        self.Record = [self.FromIP + ':' + str(self.FromPort), \
-                       self.ToIP + ':' + str(self.ToPort), \
-                       str(self.NextSeqNum), str(0)]
-        return struct.pack('!2H2I4H' + str(len(packet)) + 's', \
-                           self.FromPort, self.ToPort, \
-                           self.NextSeqNum, 0, \
-                           0, 0, checkSum, 0, \
-                           packet)
-
-    '''
-    Send out formatted segment and update log file and stats accordingly.
-    '''
-    def _sendPak(self, packet):
-        self.Sok.sendto(packet, (self.ToIP, self.ToPort))
-        self.Record.insert(0, str(datetime.datetime.now()))
-        self.Record.append(str(self.EstimatedRTT))
-        self.Log.write(', '.join(self.Record) + '\n')
-        self.Record = []
-        self.Stat[0] += len(packet)
-        self.Stat[1] += 1
+                    self.Segments.close()
+                    done = True
 
     '''
-    Generate checksum out of input array nums.
+    Generate TCP-styled packet out of the original segment of size bytes.
+    The segment is copied out of the mapping once, straight behind the
+    header.
     '''
-    def _gene(self, nums):
-        s = 0
-        while nums != []:
-            s = self._add(s, nums.pop(), 65535)
-        return 65535 - s
+    def _format(self, size):
+        return codec.encode(self.FromPort, self.ToPort, \
+                            self.NextOffset & 0xFFFFFFFF, 0, 0, \
+                            payload=self.Segments.get(self.NextOffset, size))
 
     '''
-    Fixed-length unsigned integer increment. The length is specified by
-    base.
+    Queue formatted segment to be sent with the next batch and update log
+    file and stats accordingly.
+    seq is its unwrapped offset and kind its eventlog flags.
     '''
-    def _add(self, num, increment, base=0xFFFFFFFF):
-        num += increment
-        if num > base:
-            num -= (base + 1)
-        return num
+    def _sendPak(self, packet, seq, kind=0):
+        self.Out.add(packet, (self.ToIP, self.ToPort))
+        now = time.time()
+        self.Pacer.sent(len(packet), now, \
+                        self.CC.Cwnd * ((self.SegSize or 0) + 20), \
+                        self.EstimatedRTT, self.CC.Cwnd < self.CC.SSThresh)
+        self.Log.write(now, kind, self.FromPort, self.ToPort, \
+                       seq & 0xFFFFFFFF, 0, self.EstimatedRTT, self.CC.Cwnd)
+        self.Stat[0] += len(packet)
+        self.Stat[1] += 1
 
     '''
     Update corresponding time variables according to (newly updated)
     SampleRTT. EWMA model is used here.
     '''
     def _update(self):
+        self.RTTs.add(self.SampleRTT)
         if self.EstimatedRTT == 0:
             self.EstimatedRTT = self.SampleRTT
         else:
@@ -259,16 +752,85 @@ class Sender:
                                 0.125 * self.SampleRTT
         self.DevRTT = 0.75 * self.DevRTT + \
                       0.25 * abs(self.SampleRTT - self.EstimatedRTT)
-        self.TimeoutInterval = self.EstimatedRTT + 4 * self.DevRTT
+        self.TimeoutInterval = min(max(self.EstimatedRTT + 4 * self.DevRTT, \
+                                       MIN_RTO), MAX_RTO)
+
+'''
+Largest segment, TCP header included, that fits the MTU of the route to
+rIP along with the IP and UDP headers; MSS where the MTU is not known.
+'''
+def localMSS(rIP):
+    sok = socket(AF_INET, SOCK_DGRAM)
+    try:
+        sok.connect((rIP, 9)) # nothing is sent, it only picks the route
+        mtu = sok.getsockopt(IPPROTO_IP, IP_MTU)
+    except error:
+        return MSS
+    finally:
+        sok.close()
+    return min(codec.MAX_MSS, mtu - 28)
 
 if __name__ == '__main__':
-    para = sys.argv
+    # Options may precede or follow the positional arguments:
+    #   -e        use the event-driven engine instead of the recvACK thread
+    #   -c <cc>   congestion control: reno (default), cubic or fixed
+    #   -s        selective acknowledgments, retransmit only the holes
+    #   -b        binary event log, render it with logdump.py
+    #   -n <N>    log one in N events, 0 for none but FIN-related ones
+    #   -M        batch system calls with sendmmsg and recvmmsg
+    #   -p        pace segments over the RTT instead of sending bursts
+    #   -r <kbps> cap the sending rate by a token bucket
+    #   -k <B>    size of the token bucket in bytes, by default what the
+    #             rate fills in 10 ms
+    #   -S <B>    largest segment to send, TCP header included, or 'mtu'
+    #             for what the MTU of the route allows; 532 by default
+    #   -P        start from 532 and probe for larger segments up to -S
+    #   -I <s>    print a summary line of live metrics to stderr every s
+    #             seconds
+    #   -E <addr> serve live metrics at a port of 127.0.0.1 over HTTP, or
+    #             at the path of a Unix socket
+    #   -z <L>    offer to compress the stream with zlib at level L (1-9)
+    opts, args = getopt.gnu_getopt(sys.argv[1:], 'ec:sbn:Mpr:k:S:PI:E:z:')
+    para, kw = [sys.argv[0]] + args, {}
+    for opt, val in opts:
+        if opt == '-e':
+            kw['engine'] = 'event'
+        elif opt == '-c':
+            kw['cc'] = val
+        elif opt == '-s':
+            kw['sack'] = True
+        elif opt == '-b':
+            kw['binaryLog'] = True
+        elif opt == '-n':
+            kw['logSample'] = int(val)
+        elif opt == '-M':
+            kw['mmsg'] = True
+        elif opt == '-p':
+            kw['pace'] = True
+        elif opt == '-r':
+            kw['rate'] = float(val) * 1000 / 8
+        elif opt == '-k':
+            kw['burst'] = int(val)
+        elif opt == '-S':
+            kw['mss'] = val
+        elif opt == '-P':
+            kw['probe'] = True
+        elif opt == '-I':
+            kw['metricsInterval'] = float(val)
+        elif opt == '-E':
+            kw['metricsEndpoint'] = val
+        elif opt == '-z':
+            kw['compress'] = int(val)
+    if 'mss' in kw: # the route is only known along with the remote IP
+        kw['mss'] = localMSS(para[2] if len(para) > 2 else 'localhost') \
+                    if kw['mss'] == 'mtu' else int(kw['mss'])
     if len(para) == 1:
         s = Sender('file_send.txt', 'localhost', \
-                   41192, 41191, 'log_send.txt', 5)
+                   41192, 41191, 'log_send.txt', 5, **kw)
     else:
-        if len(para) == 6:
-            para.append(1)
+        # Without a window size the window is left to congestion control.
+        windowSize = int(para[6]) if len(para) > 6 else None
         s = Sender(para[1], para[2], int(para[3]), \
-                   int(para[4]), para[5], para[6])
+                   int(para[4]), para[5], windowSize, **kw)
     s.run()
+    sys.exit(1 if s.Verified is False else 0)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+'Batched datagram I/O of TCP sender and receiver.'
+
+__author__ = 'Sirui Tan'
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+
+BATCH = 64 # most datagrams moved by one system call
+# Fewer datagrams than this go out one sendto each, since filling in the
+# headers of sendmmsg costs more than the calls it saves.
+MIN_BATCH = 8
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0x40)
+MSG_WAITFORONE = 0x10000 # recvmmsg blocks only until the first datagram
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [('base', ctypes.c_void_p), ('len', ctypes.c_size_t)]
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('name', ctypes.c_void_p), ('namelen', ctypes.c_uint32), \
+                ('iov', ctypes.POINTER(_IOVec)), ('iovlen', ctypes.c_size_t), \
+                ('control', ctypes.c_void_p), \
+                ('controllen', ctypes.c_size_t), ('flags', ctypes.c_int)]
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('hdr', _MsgHdr), ('len', ctypes.c_uint)]
+
+# sendmmsg and recvmmsg are Linux only; elsewhere a loop of sendto and
+# non-blocking recvfrom calls does the same work. Filling in their headers
+# through ctypes costs about what the system calls they save do, so they
+# only pay where system calls are expensive and are used on request.
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _sendmmsg, _recvmmsg = _libc.sendmmsg, _libc.recvmmsg
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), \
+                          ctypes.c_uint, ctypes.c_int]
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), \
+                          ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+except (OSError, AttributeError, TypeError):
+    _sendmmsg, _recvmmsg = None, None
+
+'''
+The socket.error of the errno left by a failed libc call.
+'''
+def _error():
+    code = ctypes.get_errno()
+    return socket.error(code, os.strerror(code))
+
+'''
+Headers of count messages of one buffer each, with room for an IPv4
+socket address per message. The kernel writes back sockaddr_in lengths,
+so those are only set once.
+'''
+def _headers(count):
+    msgs, iovs = (_MMsgHdr * count)(), (_IOVec * count)()
+    names = [ctypes.create_string_buffer(16) for i in range(count)]
+    for i in range(count):
+        msgs[i].hdr.iov = ctypes.pointer(iovs[i])
+        msgs[i].hdr.iovlen = 1
+        msgs[i].hdr.name = ctypes.addressof(names[i])
+        msgs[i].hdr.namelen = 16
+    return msgs, iovs, names
+
+class Writer:
+    '''
+    Queue outgoing datagrams and send them together, one sendto each or,
+    with mmsg where available, one sendmmsg per BATCH datagrams.
+    '''
+    def __init__(self, sok, mmsg=False):
+        self.Sok, self.Pending = sok, []
+        self.Addrs = {} # (host, port) to packed sockaddr_in
+        self.MMsg = mmsg and _sendmmsg is not None
+        if self.MMsg:
+            self.Msgs, self.IOVs, self.Names = _headers(BATCH)
+            self.Named = [None] * BATCH # addresses held by Names
+
+    '''
+    Queue packet for addr, flushing the queue once it holds BATCH.
+    '''
+    def add(self, packet, addr):
+        self.Pending.append((packet, addr))
+        if len(self.Pending) >= BATCH:
+            self.flush()
+
+    '''
+    Send every queued datagram, in order. A datagram too big for the
+    route is dropped as a router would drop it.
+    '''
+    def flush(self):
+        pending, self.Pending = self.Pending, []
+        if pending == []:
+            return
+        if not self.MMsg or len(pending) < MIN_BATCH:
+            for packet, addr in pending:
+                try:
+                    self.Sok.sendto(packet, addr)
+                except socket.error as e:
+                    if e.args[0] != errno.EMSGSIZE:
+                        raise
+            return
+        # One copy of all packets side by side, which the buffers point in.
+        packets = [bytes(packet) for packet, addr in pending]
+        data = b''.join(packets)
+        pointer = ctypes.c_char_p(data) # refers to data, no copy
+        base = ctypes.cast(pointer, ctypes.c_void_p).value
+        for i in range(len(pending)):
+            iov = self.IOVs[i]
+            iov.base, iov.len = base, len(packets[i])
+            base += iov.len
+            if self.Named[i] != pending[i][1]:
+                self.Names[i].raw = self._sockaddr(pending[i][1])
+                self.Named[i] = pending[i][1]
+        sent = 0
+        while sent < len(pending):
+            count = _sendmmsg(self.Sok.fileno(), \
+                              ctypes.cast(ctypes.byref(self.Msgs, sent * \
+                                  ctypes.sizeof(_MMsgHdr)), \
+                                  ctypes.POINTER(_MMsgHdr)), \
+                              len(pending) - sent, 0)
+            if count < 0:
+                if ctypes.get_errno() == errno.EINTR:
+                    continue
+                if ctypes.get_errno() == errno.EMSGSIZE:
+                    count = 1 # the first is dropped, see below
+                else:
+                    raise _error()
+            sent += count
+
+    '''
+    Packed sockaddr_in of addr, resolving its host name once.
+    '''
+    def _sockaddr(self, addr):
+        if addr not in self.Addrs:
+            host = socket.inet_aton(socket.gethostbyname(addr[0]))
+            self.Addrs[addr] = struct.pack('=H', socket.AF_INET) + \
+                               struct.pack('!H', addr[1]) + host + \
+                               b'\x00' * 8
+        return self.Addrs[addr]
+
+class Reader:
+    '''
+    Receive all the datagrams queued on a socket at once, by non-blocking
+    recvfrom calls or, with mmsg where available, one recvmmsg per BATCH
+    datagrams.
+    '''
+    def __init__(self, sok, size, mmsg=False):
+        self.Sok, self.Size = sok, size
+        self.Addrs = {} # packed sockaddr_in to (host, port)
+        self.MMsg = mmsg and _recvmmsg is not None
+        if self.MMsg:
+            self.Msgs, self.IOVs, self.Names = _headers(BATCH)
+            self.Bufs = [ctypes.create_string_buffer(size) \
+                         for i in range(BATCH)]
+            for i in range(BATCH):
+                self.IOVs[i].base = ctypes.addressof(self.Bufs[i])
+                self.IOVs[i].len = size
+
+    '''
+    At most BATCH pending datagrams of at most Size bytes each, as a list
+    of (message, (host, port)); empty if there is none. With wait, block
+    until there is one, on a blocking socket.
+    '''
+    def read(self, wait=False):
+        if not self.MMsg:
+            return self._fallback(wait)
+        flags = MSG_WAITFORONE if wait else MSG_DONTWAIT
+        count = _recvmmsg(self.Sok.fileno(), self.Msgs, BATCH, flags, None)
+        while count < 0:
+            if ctypes.get_errno() in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            if ctypes.get_errno() != errno.EINTR:
+                raise _error()
+            count = _recvmmsg(self.Sok.fileno(), self.Msgs, BATCH, flags, \
+                              None)
+        result = []
+        for i in range(count):
+            name = self.Names[i].raw
+            if name not in self.Addrs:
+                self.Addrs[name] = (socket.inet_ntoa(name[4:8]), \
+                                    struct.unpack('!H', name[2:4])[0])
+            result.append((ctypes.string_at(self.Bufs[i], self.Msgs[i].len), \
+                           self.Addrs[name]))
+        return result
+
+    def _fallback(self, wait):
+        result = [self.Sok.recvfrom(self.Size)] if wait else []
+        while len(result) < BATCH:
+            try:
+                result.append(self.Sok.recvfrom(self.Size, MSG_DONTWAIT))
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+        return result
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+'Throughput benchmark of TCP sender and receiver over the link emulator.'
+
+__author__ = 'Sirui Tan'
+
+import sys
+import os
+import getopt
+import subprocess
+import filecmp
+import shutil
+import tempfile
+import time
+import resource
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Statistics printed by TCP_send.py, by the keys they are stored under.
+STATS = [('bytes', 'Total bytes sent = '), ('segments', 'Segments sent = '), \
+         ('retrans', 'Segments retransmitted = '), \
+         ('fast', 'Segments fast retransmitted = ')]
+COLUMNS = ['window', 'loss', 'time', 'goodput', 'bytes', 'cpu', \
+           'segments', 'retrans', 'fast', 'ok']
+
+def _start(script, args):
+    return subprocess.Popen([sys.executable, os.path.join(HERE, script)] + \
+                            args, stdout=subprocess.PIPE, \
+                            stderr=subprocess.STDOUT)
+
+def _stop(process):
+    if process.poll() is None:
+        process.terminate()
+    return process.communicate()[0].decode()
+
+'''
+CPU seconds used by the child processes waited for so far.
+'''
+def _cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+'''
+Send fileName once through a link emulator losing the given fraction of
+segments, on ports port to port + 2. Returns the results as a dictionary
+of the COLUMNS but window and loss; time is None if the sender did not
+finish within timeout seconds. bytes are those the sender put on the wire
+and cpu the seconds sender and receiver spent on the CPU.
+'''
+def transfer(fileName, workDir, port, window, loss, sendOpts=[], \
+             recvOpts=[], linkOpts=[], timeout=120):
+    received = os.path.join(workDir, 'recv_%d' % port)
+    cpu = _cpu()
+    link = _start('linkemu.py', linkOpts + ['-L', str(loss * 100), \
+                  str(port), 'localhost', str(port + 1)])
+    recv = _start('TCP_recv.py', recvOpts + [received, str(port + 1), \
+                  'localhost', str(port + 2), \
+                  os.path.join(workDir, 'log_recv_%d' % port)])
+    time.sleep(0.5) # let them bind their ports
+    start = time.time()
+    send = _start('TCP_send.py', sendOpts + [fileName, 'localhost', \
+                  str(port), str(port + 2), \
+                  os.path.join(workDir, 'log_send_%d' % port), str(window)])
+    while send.poll() is None and time.time() < start + timeout:
+        time.sleep(0.002)
+    elapsed = time.time() - start if send.poll() is not None else None
+    output = _stop(send)
+    time.sleep(0.1) # the FIN-ACK may still be on its way
+    _stop(recv)
+    cpu = _cpu() - cpu # before the link is waited for
+    _stop(link)
+    result = {'time': elapsed, 'goodput': None, 'cpu': cpu}
+    for key, label in STATS:
+        result[key] = None
+        for line in output.splitlines():
+            if line.startswith(label):
+                result[key] = int(line[len(label):])
+    result['ok'] = elapsed is not None and os.path.exists(received) and \
+                   filecmp.cmp(fileName, received, shallow=False)
+    if elapsed is not None:
+        result['goodput'] = os.path.getsize(fileName) * 8 / elapsed / 1e6
+    if os.path.exists(received):
+        os.remove(received)
+    return result
+
+'''
+Run every combination of windows and losses repeat times, keeping the run
+of median completion time of each. Yields one row of COLUMNS each.
+'''
+def matrix(fileName, windows, losses, repeat=1, port=43000, **kw):
+    workDir = tempfile.mkdtemp()
+    try:
+        for window in windows:
+            for loss in losses:
+                runs = []
+                for i in range(repeat):
+                    runs.append(transfer(fileName, workDir, port, window, \
+                                         loss, **kw))
+                    port += 3
+                runs.sort(key=lambda run: float('inf') if run['time'] is None \
+                          else run['time'])
+                row = runs[(len(runs) - 1) // 2]
+                row['window'], row['loss'] = window, loss
+                row['ok'] = all(run['ok'] for run in runs)
+                yield row
+    finally:
+        shutil.rmtree(workDir)
+
+def _format(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '%.3f' % value
+    return str(value)
+
+'''
+Rows of a CSV file written by the -o option.
+'''
+def load(fileName):
+    f = open(fileName)
+    lines = f.read().splitlines()
+    f.close()
+    header = lines[0].split(',')
+    rows = []
+    for line in lines[1:]:
+        row = dict(zip(header, line.split(',')))
+        rows.append(row)
+    return rows
+
+'''
+Messages about rows slower than the same window and loss in baseline by
+more than tolerance, a fraction.
+'''
+def regressions(rows, baseline, tolerance):
+    before = dict(((row['window'], row['loss']), row) for row in baseline)
+    messages = []
+    for row in rows:
+        old = before.get((_format(row['window']), _format(row['loss'])))
+        if old is None or old['time'] == '-':
+            continue
+        if row['time'] is None or \
+           row['time'] > float(old['time']) * (1 + tolerance):
+            messages.append('window %s, loss %s: %s s against %s s' % \
+                            (row['window'], _format(row['loss']), \
+                             _format(row['time']), old['time']))
+    return messages
+
+if __name__ == '__main__':
+    # python bench.py [options]
+    #   -f <file>    file to send, by default random bytes of -z size; try
+    #                a text file with -S '-z 6' to see compression at work
+    #   -z <bytes>   size of the random file, 1000000 by default
+    #   -w <list>    window sizes, comma-separated, 5,20,50 by default
+    #   -l <list>    loss rates in percent, comma-separated, 0,1,5 by default
+    #   -r <N>       runs of each combination, the median is reported
+    #   -S <opts>    options of TCP_send.py, e.g. '-e -s'
+    #   -R <opts>    options of TCP_recv.py
+    #   -L <opts>    options of linkemu.py besides loss, e.g. '-d 0.01'
+    #   -t <s>       time limit of a transfer, 120 by default
+    #   -p <port>    first port to use, 43000 by default
+    #   -o <csv>     save the results
+    #   -b <csv>     compare with results saved before and exit with 1 if
+    #                any combination is slower by more than -T percent
+    #   -T <pct>     tolerance of -b, 25 by default
+    opts, args = getopt.gnu_getopt(sys.argv[1:], 'f:z:w:l:r:S:R:L:t:p:o:b:T:')
+    fileName, size, windows, losses = None, 1000000, [5, 20, 50], [0, 1, 5]
+    kw, output, baseline, tolerance = {}, None, None, 0.25
+    for opt, val in opts:
+        if opt == '-f':
+            fileName = val
+        elif opt == '-z':
+            size = int(val)
+        elif opt == '-w':
+            windows = [int(w) for w in val.split(',')]
+        elif opt == '-l':
+            losses = [float(l) for l in val.split(',')]
+        elif opt == '-r':
+            kw['repeat'] = int(val)
+        elif opt == '-S':
+            kw['sendOpts'] = val.split()
+        elif opt == '-R':
+            kw['recvOpts'] = val.split()
+        elif opt == '-L':
+            kw['linkOpts'] = val.split()
+        elif opt == '-t':
+            kw['timeout'] = float(val)
+        elif opt == '-p':
+            kw['port'] = int(val)
+        elif opt == '-o':
+            output = val
+        elif opt == '-b':
+            baseline = load(val)
+        elif opt == '-T':
+            tolerance = float(val) / 100
+    temporary = fileName is None
+    if temporary:
+        fd, fileName = tempfile.mkstemp()
+        os.write(fd, os.urandom(size))
+        os.close(fd)
+    rows = []
+    print(''.join('%-10s' % column for column in COLUMNS))
+    try:
+        for row in matrix(fileName, windows, [l / 100 for l in losses], \
+                          **kw):
+            row['loss'] = row['loss'] * 100
+            rows.append(row)
+            print(''.join('%-10s' % _format(row[column]) \
+                          for column in COLUMNS))
+            sys.stdout.flush()
+    finally:
+        if temporary:
+            os.remove(fileName)
+    if output is not None:
+        f = open(output, 'w')
+        f.write(','.join(COLUMNS) + '\n')
+        for row in rows:
+            f.write(','.join(_format(row[column]) for column in COLUMNS) + \
+                    '\n')
+        f.close()
+    failed = not all(row['ok'] for row in rows)
+    if failed:
+        print('Some transfers did not complete intact.')
+    if baseline is not None:
+        messages = regressions(rows, baseline, tolerance)
+        for message in messages:
+            print('Regression: ' + message)
+        failed = failed or messages != []
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+'Micro-benchmark of checksum.py against the former per-word loop.'
+
+__author__ = 'Sirui Tan'
+
+import os
+import sys
+import struct
+import timeit
+import checksum
+
+MSS = 532
+
+'''
+The implementation formerly found in Sender._gene and
+Receiver.notCorrupt: a format string built per packet, a list of words and
+an interpreted pop() loop. Note it drops carries instead of folding them,
+so its values differ from RFC 1071 ones.
+'''
+def legacy(packet):
+    calc = (packet + b'\x00') if len(packet) % 2 != 0 else packet
+    nums = list(struct.unpack('!' + str(len(calc) // 2) + 'H', calc))
+    s = 0
+    while nums != []:
+        s += nums.pop()
+        if s > 65535:
+            s -= 65536
+    return 65535 - s
+
+'''
+Reference RFC 1071 implementation used to validate checksum.checksum.
+'''
+def reference(packet):
+    calc = (packet + b'\x00') if len(packet) % 2 != 0 else packet
+    s = sum(struct.unpack('!' + str(len(calc) // 2) + 'H', calc))
+    while s >> 16:
+        s = (s & 0xFFFF) + (s >> 16)
+    return 0xFFFF - s
+
+def main(number):
+    packets = [os.urandom(size) for size in (MSS, MSS - 1, 20, 1500, 9000)]
+    # Packets are built in a bytearray by codec.encode.
+    packets += [bytearray(packet) for packet in packets]
+    for packet in packets:
+        assert checksum.checksum(packet) == reference(bytes(packet))
+    print('type       size   legacy(us)  checksum(us)  speedup')
+    for packet in packets:
+        t0 = timeit.timeit(lambda: legacy(bytes(packet)), number=number)
+        t1 = timeit.timeit(lambda: checksum.checksum(packet), number=number)
+        print('%-10s %-6d %-11.2f %-13.2f %.1fx' % \
+              (type(packet).__name__, len(packet), t0 * 1e6 / number, \
+               t1 * 1e6 / number, t0 / t1))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+'Internet checksum (RFC 1071) shared by TCP sender and receiver.'
+
+__author__ = 'Sirui Tan'
+
+import array
+import sys
+
+LITTLE = sys.byteorder == 'little'
+
+'''
+The first n bytes of data as native 16-bit words, n being even. Python 3
+casts a view of data without copying it; Python 2 has no cast, but its
+array reads the buffer of data directly, whereas bytes() of a bytearray
+would copy it once more beforehand.
+'''
+if hasattr(memoryview, 'cast'):
+    def _words(data, n):
+        return memoryview(data)[:n].cast('H')
+else:
+    def _words(data, n):
+        words = array.array('H')
+        words.fromstring(buffer(data, 0, n))
+        return words
+
+'''
+One's complement sum of data taken as 16-bit big-endian words, padding an
+odd-lengthed data with a zero byte.
+
+The words are summed in native byte order in one pass and the carries
+folded afterwards. The one's complement sum commutes with byte swapping
+(RFC 1071, section 2), so the result only needs swapping once.
+'''
+def onesSum(data):
+    odd = len(data) % 2
+    s = sum(_words(data, len(data) - odd))
+    if odd: # the last byte is the high byte of a word padded with zero
+        s += bytearray(data[-1:])[0] << (0 if LITTLE else 8)
+    while s >> 16:
+        s = (s & 0xFFFF) + (s >> 16)
+    if LITTLE:
+        s = ((s & 0xFF) << 8) | (s >> 8)
+    return s
+
+'''
+Checksum to place in a header whose checksum field is 0 in data.
+'''
+def checksum(data):
+    return 0xFFFF - onesSum(data)
+
+'''
+Whether data, checksum field included, is free of detected bit errors.
+'''
+def verify(data):
+    return onesSum(data) == 0xFFFF
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+'Precompiled TCP segment codec shared by TCP sender and receiver.'
+
+__author__ = 'Sirui Tan'
+
+import struct
+import checksum
+
+# Source port, destination port, SeqNum, ACK number, data offset and
+# flags, window, checksum and urgent pointer.
+HEADER = struct.Struct('!2H2I4H')
+SIZE = HEADER.size
+CHECKSUM = struct.Struct('!H') # the checksum field, at CHECKSUM_AT
+CHECKSUM_AT = 16
+BLOCK = struct.Struct('!2I') # edges of a SACK block
+# Two no-operations then the SACK option of 0 to 4 blocks, by block count.
+SACK = [struct.Struct('!4B' + str(2 * n) + 'I') for n in range(5)]
+WINDOW_SCALE = struct.Struct('!4B') # a no-operation then the option
+MSS = struct.Struct('!2BH') # the maximum segment size option
+VALUE = struct.Struct('!H') # the value of the MSS option
+# An experimental option (kind 254, RFC 6994) holding a 64-bit value
+# after its experiment ID, and that value.
+EXPERIMENT = struct.Struct('!2BHQ')
+EXPERIMENT_VALUE = struct.Struct('!Q')
+EXPERIMENT_ID = struct.Struct('!2BH') # one holding bytes instead
+
+# Bits of the flags word.
+FIN, SYN, ACK = 1, 2, 16
+
+# Largest segment, TCP header included, that fits a UDP datagram over IPv4.
+MAX_MSS = 65507
+# Payloads are whole multiples of UNIT bytes, but for the last one of the
+# stream, so that a receiver may keep track of them in blocks of UNIT.
+UNIT = 16
+
+# Experiment IDs: the length of the stream, which SYNs tell, and the offset
+# the receiver has the stream up to, which SYN-ACKs tell to resume from.
+LENGTH, RESUME = 0x4C45, 0x5245
+# Experiment ID of the compression method a SYN offers and a SYN-ACK
+# accepts, and the methods.
+COMPRESS, ZLIB = 0x5A4C, 1
+# Experiment ID of the SHA-256 digest of the stream, which FINs and their
+# ACKs carry.
+DIGEST = 0x4447
+
+'''
+Encode a segment in one pass: the header is packed, options and payload
+copied behind it and the checksum, unless check is False, computed over
+the result and packed into its field in place. The data offset is only
+filled in when there are options.
+'''
+def encode(sPort, dPort, seq, ack, flags, window=0, payload=b'', \
+           options=b'', check=True):
+    if options:
+        flags |= ((SIZE + len(options)) // 4) << 12
+    if not check: # nothing to patch, so one immutable string will do
+        return HEADER.pack(sPort, dPort, seq, ack, flags, window, 0, 0) + \
+               options + payload
+    size = SIZE + len(options)
+    packet = bytearray(size + len(payload))
+    HEADER.pack_into(packet, 0, sPort, dPort, seq, ack, flags, window, 0, 0)
+    packet[SIZE:size] = options
+    packet[size:] = payload
+    CHECKSUM.pack_into(packet, CHECKSUM_AT, checksum.checksum(packet))
+    return packet
+
+'''
+The header fields of a segment, read in place.
+'''
+def decode(packet):
+    return HEADER.unpack_from(packet)
+
+'''
+Zero-copy view of the payload of a segment, behind its options. flags is
+the decoded flags word.
+'''
+def payload(packet, flags):
+    return memoryview(packet)[max(SIZE, (flags >> 12) * 4):]
+
+'''
+Options of a segment as a dictionary from kind to value bytes. flags is
+the decoded flags word. Experimental options (kind 254) are keyed by
+their experiment ID instead, which is never a kind, with the value that
+follows it.
+'''
+def options(packet, flags):
+    result = {}
+    pos, end = SIZE, min(len(packet), (flags >> 12) * 4)
+    while pos < end:
+        kind = ord(packet[pos:pos + 1])
+        if kind == 0: # end of option list
+            break
+        if kind == 1: # no-operation
+            pos += 1
+            continue
+        length = ord(packet[pos + 1:pos + 2])
+        if length < 2:
+            break
+        if kind == 254 and length >= 4: # skip to the experiment ID
+            kind = VALUE.unpack_from(packet, pos + 2)[0]
+            pos, length = pos + 2, length - 2
+        result[kind] = packet[pos + 2:pos + length]
+        pos += length
+    return result
+
+'''
+The window scale option (kind 3) for shift, padded to 4 bytes.
+'''
+def windowScale(shift):
+    return WINDOW_SCALE.pack(1, 3, 3, shift)
+
+'''
+The maximum segment size option (kind 2) for size bytes.
+'''
+def mss(size):
+    return MSS.pack(2, 4, size)
+
+'''
+The segment size in the value of an MSS option.
+'''
+def mssValue(value):
+    return VALUE.unpack_from(value)[0]
+
+'''
+The experimental option with experiment ID exid holding value, a 64-bit
+unsigned integer.
+'''
+def experiment(exid, value):
+    return EXPERIMENT.pack(254, EXPERIMENT.size, exid, value)
+
+'''
+The experimental option with experiment ID exid holding the bytes data,
+at most 36 of them.
+'''
+def experimentData(exid, data):
+    return EXPERIMENT_ID.pack(254, EXPERIMENT_ID.size + len(data), exid) + \
+           data
+
+'''
+The integer in the value of an experimental option built by experiment.
+'''
+def experimentValue(value):
+    return EXPERIMENT_VALUE.unpack_from(value)[0]
+
+'''
+The SACK option (kind 5) for at most 4 [left, right) blocks of 32-bit
+sequence numbers, padded to a multiple of 4 bytes; empty without blocks.
+'''
+def sack(blocks):
+    if blocks == []:
+        return b''
+    return SACK[len(blocks)].pack(1, 1, 5, 2 + 8 * len(blocks), \
+                                  *[n for block in blocks for n in block])
+
+'''
+The [left, right) blocks of the value of a SACK option.
+'''
+def sackBlocks(value):
+    return [BLOCK.unpack_from(value, at) \
+            for at in range(0, len(value) - 7, 8)]
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+'Congestion control algorithms driving the TCP sender\'s window.'
+
+__author__ = 'Sirui Tan'
+
+import time
+
+class Fixed:
+    '''
+    Constant window of WindowSize segments, i.e. no congestion control.
+
+    Every algorithm exposes the congestion window Cwnd and the slow start
+    threshold SSThresh in segments, and is notified by the sender of new
+    ACKs, duplicate ACKs during fast recovery, and the two kinds of loss
+    (triple duplicate ACK and timeout).
+    '''
+    name = 'fixed'
+
+    def __init__(self, windowSize=None):
+        self.Cwnd = float(windowSize or 1)
+        self.SSThresh = self.Cwnd
+        self.MaxWindow = windowSize
+        self.InRecovery = False
+
+    '''
+    Number of segments allowed in flight.
+    '''
+    def window(self):
+        w = max(1, int(self.Cwnd))
+        if self.MaxWindow is not None:
+            w = min(w, self.MaxWindow)
+        return w
+
+    '''
+    acked segments are newly acknowledged by a cumulative ACK.
+    '''
+    def onAck(self, acked, rtt, now=None):
+        pass
+
+    '''
+    A further duplicate ACK arrived while in fast recovery.
+    '''
+    def onDupAck(self):
+        pass
+
+    '''
+    Triple duplicate ACK: a segment is lost but the pipe still flows.
+    '''
+    def enterRecovery(self, inFlight, now=None):
+        self.InRecovery = True
+
+    '''
+    The ACK covering the lost segment arrived.
+    '''
+    def exitRecovery(self):
+        self.InRecovery = False
+
+    '''
+    The retransmission timer expired.
+    '''
+    def onTimeout(self, inFlight, now=None):
+        self.InRecovery = False
+
+class Reno(Fixed):
+    '''
+    TCP Reno (RFC 5681): slow start, congestion avoidance with additive
+    increase, multiplicative decrease on loss and fast recovery.
+    '''
+    name = 'reno'
+
+    def __init__(self, windowSize=None):
+        Fixed.__init__(self, windowSize)
+        self.Cwnd, self.SSThresh = 1.0, float('inf')
+
+    def onAck(self, acked, rtt, now=None):
+        if self.InRecovery:
+            return
+        if self.Cwnd < self.SSThresh: # slow start
+            self.Cwnd += acked
+        else: # congestion avoidance, one segment per RTT
+            self.Cwnd += float(acked) / self.Cwnd
+        self._clamp()
+
+    def onDupAck(self):
+        if self.InRecovery: # every duplicate ACK means a segment has left
+            self.Cwnd += 1
+            self._clamp()
+
+    def enterRecovery(self, inFlight, now=None):
+        self.SSThresh = max(inFlight / 2.0, 2.0)
+        self.Cwnd = self.SSThresh + 3
+        self.InRecovery = True
+
+    def exitRecovery(self):
+        if self.InRecovery:
+            self.Cwnd = self.SSThresh
+        self.InRecovery = False
+
+    def onTimeout(self, inFlight, now=None):
+        self.SSThresh = max(inFlight / 2.0, 2.0)
+        self.Cwnd = 1.0
+        self.InRecovery = False
+
+    '''
+    Keep Cwnd from growing far beyond the window cap, which would make it
+    take many RTTs to react once losses start.
+    '''
+    def _clamp(self):
+        if self.MaxWindow is not None:
+            self.Cwnd = min(self.Cwnd, float(self.MaxWindow))
+
+class Cubic(Reno):
+    '''
+    CUBIC (RFC 8312): after a loss the window follows a cubic function of
+    the time since that loss, centred on the window WMax at which it
+    happened, and never grows slower than Reno would (TCP-friendly region).
+    '''
+    name = 'cubic'
+    C, Beta = 0.4, 0.7
+
+    def __init__(self, windowSize=None):
+        Reno.__init__(self, windowSize)
+        self.WMax, self.K = 0.0, 0.0
+        self.EpochStart, self.WEst = None, 0.0
+
+    def onAck(self, acked, rtt, now=None):
+        if self.InRecovery:
+            return
+        if self.Cwnd < self.SSThresh:
+            self.Cwnd += acked
+            self._clamp()
+            return
+        now = time.time() if now is None else now
+        if self.EpochStart is None: # first ACK of a congestion epoch
+            self.EpochStart = now
+            if self.Cwnd < self.WMax:
+                self.K = ((self.WMax - self.Cwnd) / self.C) ** (1.0 / 3)
+            else:
+                self.K, self.WMax = 0.0, self.Cwnd
+            self.WEst = self.Cwnd
+        t = now - self.EpochStart + rtt
+        target = self.C * (t - self.K) ** 3 + self.WMax
+        self.WEst += 3 * (1 - self.Beta) / (1 + self.Beta) * \
+                     acked / self.Cwnd
+        if self.WEst > target:
+            target = self.WEst
+        if target > self.Cwnd:
+            self.Cwnd += (target - self.Cwnd) * acked / self.Cwnd
+        else: # plateau around WMax
+            self.Cwnd += 0.01 * acked / self.Cwnd
+        self._clamp()
+
+    def enterRecovery(self, inFlight, now=None):
+        self._reduce()
+        self.Cwnd = self.SSThresh + 3
+        self.InRecovery = True
+
+    def onTimeout(self, inFlight, now=None):
+        self._reduce()
+        self.Cwnd = 1.0
+        self.InRecovery = False
+
+    '''
+    Remember where the loss happened and start a new epoch.
+    '''
+    def _reduce(self):
+        if self.Cwnd < self.WMax: # fast convergence
+            self.WMax = self.Cwnd * (1 + self.Beta) / 2
+        else:
+            self.WMax = self.Cwnd
+        self.SSThresh = max(self.Cwnd * self.Beta, 2.0)
+        self.EpochStart = None
+
+ALGORITHMS = dict((cls.name, cls) for cls in (Fixed, Reno, Cubic))
+
+'''
+Instantiate the algorithm registered under name.
+'''
+def create(name, windowSize=None):
+    if name not in ALGORITHMS:
+        raise ValueError('Unknown congestion control ' + repr(name) + \
+                         ', choose from ' + ', '.join(sorted(ALGORITHMS)))
+    return ALGORITHMS[name](windowSize)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+'Text and binary ring-buffer event logs of TCP sender and receiver.'
+
+__author__ = 'Sirui Tan'
+
+import struct
+import datetime
+import threading
+
+# Bits of an event's kind.
+IN, ACK, FIN, METRICS, SYN = 1, 2, 4, 8, 16
+
+MAGIC = b'TCPLOG1\n'
+HEADER = struct.Struct('!2H') # lengths of the local and remote IP strings
+# Time, kind, source port, destination port, SeqNum, ACK number,
+# EstimatedRTT and congestion window.
+RECORD = struct.Struct('!dB2H2I2d')
+
+'''
+Render one event in the comma-separated format of log_send.txt and
+log_recv.txt. Inbound events list the remote end first.
+'''
+def render(localIP, remoteIP, t, kind, sPort, dPort, seq, ack, rtt, cwnd):
+    if kind & IN:
+        src, dst = remoteIP + ':' + str(sPort), localIP + ':' + str(dPort)
+    else:
+        src, dst = localIP + ':' + str(sPort), remoteIP + ':' + str(dPort)
+    record = [str(datetime.datetime.fromtimestamp(t)), src, dst, \
+              str(seq), str(ack)]
+    if kind & ACK:
+        record.append('ACK')
+    if kind & SYN:
+        record.append('SYN')
+    if kind & FIN:
+        record.append('FIN')
+    if kind & METRICS:
+        record += [str(rtt), str(cwnd)]
+    return ', '.join(record)
+
+class TextLog:
+    '''
+    Write every event as a text line as soon as it happens. With sample
+    N > 1 only one in N events is kept, 0 disables logging; SYN- and
+    FIN-related events are always kept.
+    '''
+    def __init__(self, fileName, localIP, remoteIP, sample=1):
+        self.File = open(fileName, 'w')
+        self.LocalIP, self.RemoteIP = localIP, remoteIP
+        self.Sample, self.Count = sample, 0
+
+    '''
+    Whether the event of the given kind is to be recorded.
+    '''
+    def _keep(self, kind):
+        if kind & (SYN | FIN):
+            return True
+        if self.Sample <= 0:
+            return False
+        self.Count += 1
+        return self.Count % self.Sample == 0
+
+    '''
+    Record an event. rtt and cwnd are only logged when rtt is not None.
+    '''
+    def write(self, t, kind, sPort, dPort, seq, ack, rtt=None, cwnd=None):
+        if not self._keep(kind):
+            return
+        if rtt is not None:
+            kind |= METRICS
+        self.File.write(render(self.LocalIP, self.RemoteIP, t, kind, \
+                               sPort, dPort, seq, ack, rtt, cwnd) + '\n')
+
+    def close(self):
+        self.File.close()
+
+class BinaryLog(TextLog):
+    '''
+    Pack every event into a fixed-size record of a preallocated ring
+    buffer; a background thread appends filled records to the file. The
+    protocol thread never formats text nor waits on the disk unless the
+    ring is full. Render the file with logdump.py.
+    '''
+    def __init__(self, fileName, localIP, remoteIP, sample=1, \
+                 capacity=4096, interval=0.1):
+        self.File = open(fileName, 'wb')
+        self.LocalIP, self.RemoteIP = localIP, remoteIP
+        self.Sample, self.Count = sample, 0
+        local, remote = localIP.encode(), remoteIP.encode()
+        self.File.write(MAGIC + HEADER.pack(len(local), len(remote)) + \
+                        local + remote)
+        # Records [Tail, Head) are pending. Only the writer advances Head
+        # and only _drain advances Tail.
+        self.Ring = bytearray(RECORD.size * capacity)
+        self.Capacity, self.Head, self.Tail = capacity, 0, 0
+        self.Lock, self.Interval = threading.Lock(), interval
+        self.Closed = threading.Event()
+        self.Writer = threading.Thread(target=self._flusher, args=())
+        self.Writer.daemon = True
+        self.Writer.start()
+
+    def write(self, t, kind, sPort, dPort, seq, ack, rtt=None, cwnd=None):
+        if not self._keep(kind):
+            return
+        if rtt is not None:
+            kind |= METRICS
+        else:
+            rtt, cwnd = 0.0, 0.0
+        if self.Head - self.Tail >= self.Capacity:
+            self._drain() # Ring is full, flush it ourselves
+        RECORD.pack_into(self.Ring, (self.Head % self.Capacity) * \
+                         RECORD.size, t, kind, sPort, dPort, seq, ack, \
+                         rtt, cwnd or 0.0)
+        self.Head += 1
+
+    '''
+    Background thread appending pending records every Interval seconds.
+    '''
+    def _flusher(self):
+        while not self.Closed.wait(self.Interval):
+            self._drain()
+
+    '''
+    Write records [Tail, Head) to the file in at most two chunks.
+    '''
+    def _drain(self):
+        with self.Lock:
+            head, tail = self.Head, self.Tail
+            while tail < head:
+                start = tail % self.Capacity
+                end = min(self.Capacity, start + head - tail)
+                self.File.write(bytes(self.Ring[start * RECORD.size: \
+                                                end * RECORD.size]))
+                tail += end - start
+            self.Tail = tail
+
+    def close(self):
+        self.Closed.set()
+        self.Writer.join()
+        self._drain()
+        self.File.close()
+
+'''
+Open an event log, binary if requested, text otherwise.
+'''
+def openLog(fileName, localIP, remoteIP, binary=False, sample=1):
+    if binary:
+        return BinaryLog(fileName, localIP, remoteIP, sample)
+    return TextLog(fileName, localIP, remoteIP, sample)
+
+'''
+Yield the events of a binary log as text lines.
+'''
+def readBinary(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a binary TCP event log')
+    lengths = HEADER.unpack(f.read(HEADER.size))
+    localIP = f.read(lengths[0]).decode()
+    remoteIP = f.read(lengths[1]).decode()
+    while True:
+        chunk = f.read(RECORD.size)
+        if len(chunk) < RECORD.size:
+            break
+        yield render(localIP, remoteIP, *RECORD.unpack(chunk))
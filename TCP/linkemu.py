@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+'Lossy link emulator to put between TCP sender and receiver.'
+
+__author__ = 'Sirui Tan'
+
+from socket import *
+import sys
+import getopt
+import heapq
+import random
+import select
+import signal
+import time
+
+MAX_DATAGRAM = 65535
+
+class LinkEmulator:
+    '''
+    Forward the datagrams received on lPort to rIP:rPort the way a lossy
+    link would. Each datagram is lost, corrupted (one bit flipped) or
+    duplicated with the given probabilities, queued behind the others for
+    bandwidth bits per second (unlimited if None) where at most queue may
+    wait, then delayed by delay plus up to jitter seconds. With probability
+    reorder it is held hold seconds more, letting later ones pass it.
+    Datagrams longer than mtu bytes, if given, are dropped as too big.
+    '''
+    def __init__(self, lPort, rIP, rPort, loss=0.0, corrupt=0.0, \
+                 duplicate=0.0, reorder=0.0, delay=0.0, jitter=0.0, \
+                 hold=0.01, bandwidth=None, queue=1000, seed=None, \
+                 mtu=None):
+        self.Sok = socket(AF_INET, SOCK_DGRAM)
+        self.Sok.bind(('', lPort))
+        self.ToIP, self.ToPort = rIP, rPort
+        self.Loss, self.Corrupt, self.Duplicate = loss, corrupt, duplicate
+        self.Reorder, self.Hold = reorder, hold
+        self.Delay, self.Jitter = delay, jitter
+        self.Bandwidth, self.Queue, self.MTU = bandwidth, queue, mtu
+        self.Random = random.Random(seed)
+        # Heap of [departure time, serial, datagram]; Busy is when the
+        # link is done sending what is queued, Backlog what is queued.
+        self.Pending, self.Serial = [], 0
+        self.Busy, self.Backlog = 0, []
+        # Datagrams received, lost, corrupted, duplicated, reordered,
+        # dropped for want of room in the queue and dropped as too big.
+        self.Stat = [0, 0, 0, 0, 0, 0, 0]
+
+    '''
+    The main emulator function, which never returns.
+    '''
+    def run(self):
+        while True:
+            wait = None
+            if self.Pending != []:
+                wait = max(0, self.Pending[0][0] - time.time())
+            if select.select([self.Sok], [], [], wait)[0] != []:
+                message, addr = self.Sok.recvfrom(MAX_DATAGRAM)
+                self.accept(message, time.time())
+            now = time.time()
+            while self.Pending != [] and self.Pending[0][0] <= now:
+                self.Sok.sendto(heapq.heappop(self.Pending)[2], \
+                                (self.ToIP, self.ToPort))
+
+    '''
+    Decide the fate of a datagram received at time now.
+    '''
+    def accept(self, message, now):
+        self.Stat[0] += 1
+        if self.MTU is not None and len(message) > self.MTU:
+            self.Stat[6] += 1
+            return
+        if self.Random.random() < self.Loss:
+            self.Stat[1] += 1
+            return
+        copies = 1
+        if self.Random.random() < self.Duplicate:
+            self.Stat[3] += 1
+            copies = 2
+        for i in range(copies):
+            if self.Random.random() < self.Corrupt:
+                self.Stat[2] += 1
+                message = self._flip(message)
+            self._enqueue(message, now)
+
+    '''
+    Queue a datagram on the link and schedule its arrival.
+    '''
+    def _enqueue(self, message, now):
+        departure = now
+        if self.Bandwidth is not None:
+            while self.Backlog != [] and self.Backlog[0] <= now:
+                heapq.heappop(self.Backlog)
+            if len(self.Backlog) >= self.Queue:
+                self.Stat[5] += 1 # tail drop
+                return
+            self.Busy = max(self.Busy, now) + \
+                        len(message) * 8.0 / self.Bandwidth
+            heapq.heappush(self.Backlog, self.Busy)
+            departure = self.Busy
+        arrival = departure + self.Delay + self.Random.random() * self.Jitter
+        if self.Random.random() < self.Reorder:
+            self.Stat[4] += 1
+            arrival += self.Hold
+        self.Serial += 1
+        heapq.heappush(self.Pending, [arrival, self.Serial, message])
+
+    '''
+    The datagram with one random bit flipped.
+    '''
+    def _flip(self, message):
+        if message == b'':
+            return message
+        data = bytearray(message)
+        bit = self.Random.randrange(len(data) * 8)
+        data[bit // 8] ^= 1 << (bit % 8)
+        return bytes(data)
+
+    def close(self):
+        self.Sok.close()
+
+
+if __name__ == '__main__':
+    # python linkemu.py [options] <listening_port> <remote_IP> <remote_port>
+    #   -L <pct>   loss rate          -C <pct>  corruption rate
+    #   -U <pct>   duplication rate   -O <pct>  reordering rate
+    #   -d <s>     propagation delay  -j <s>    uniform extra delay
+    #   -g <s>     extra delay of reordered datagrams, 0.01 by default
+    #   -B <kbps>  bandwidth          -q <N>    queue limit, 1000 datagrams
+    #   -S <seed>  random seed        -T <B>    MTU, no limit by default
+    opts, args = getopt.gnu_getopt(sys.argv[1:], 'L:C:U:O:d:j:g:B:q:S:T:')
+    para, kw = [sys.argv[0]] + args, {}
+    names = {'-L': 'loss', '-C': 'corrupt', '-U': 'duplicate', \
+             '-O': 'reorder'}
+    for opt, val in opts:
+        if opt in names:
+            kw[names[opt]] = float(val) / 100
+        elif opt == '-d':
+            kw['delay'] = float(val)
+        elif opt == '-j':
+            kw['jitter'] = float(val)
+        elif opt == '-g':
+            kw['hold'] = float(val)
+        elif opt == '-B':
+            kw['bandwidth'] = float(val) * 1000
+        elif opt == '-q':
+            kw['queue'] = int(val)
+        elif opt == '-S':
+            kw['seed'] = int(val)
+        elif opt == '-T':
+            kw['mtu'] = int(val)
+    if len(para) != 4:
+        print('Usage: python linkemu.py [options] <listening_port> ' + \
+              '<remote_IP> <remote_port>')
+        sys.exit(1)
+    link = LinkEmulator(int(para[1]), para[2], int(para[3]), **kw)
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop) # print statistics when terminated
+    try:
+        link.run()
+    except KeyboardInterrupt:
+        pass
+    print('Datagrams received = ' + str(link.Stat[0]))
+    print('Datagrams lost = ' + str(link.Stat[1]))
+    print('Datagrams corrupted = ' + str(link.Stat[2]))
+    print('Datagrams duplicated = ' + str(link.Stat[3]))
+    print('Datagrams reordered = ' + str(link.Stat[4]))
+    print('Datagrams dropped by the queue = ' + str(link.Stat[5]))
+    print('Datagrams over the MTU = ' + str(link.Stat[6]))
+    link.close()
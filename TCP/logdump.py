@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+
+'Render a binary event log as the comma-separated text log.'
+
+__author__ = 'Sirui Tan'
+
+import sys
+import eventlog
+
+if __name__ == '__main__':
+    para = sys.argv
+    if len(para) not in (2, 3):
+        print('Usage: python logdump.py <binary_log> [<text_log>]')
+        sys.exit(1)
+    out = open(para[2], 'w') if len(para) == 3 else sys.stdout
+    f = open(para[1], 'rb')
+    for line in eventlog.readBinary(f):
+        out.write(line + '\n')
+    f.close()
+    if out is not sys.stdout:
+        out.close()
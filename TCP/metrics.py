@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+'Live metrics of TCP sender and receiver, summarized and served locally.'
+
+__author__ = 'Sirui Tan'
+
+import bisect
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+# Upper bounds of the buckets of RTT histograms in seconds, doubling from
+# 100 us to about 105 s; one more bucket takes what is above.
+RTT_BOUNDS = [0.0001 * 2 ** i for i in range(21)]
+
+class Histogram:
+    '''
+    Samples counted by bucket: Counts[i] holds those up to Bounds[i] and
+    above the bound before, the last count those above every bound.
+    '''
+    def __init__(self, bounds):
+        self.Bounds = bounds
+        self.Counts = [0] * (len(bounds) + 1)
+        self.Count, self.Sum = 0, 0.0
+
+    def add(self, value):
+        self.Counts[bisect.bisect_left(self.Bounds, value)] += 1
+        self.Count += 1
+        self.Sum += value
+
+    '''
+    Upper bound of the bucket holding quantile q of the samples, None
+    without samples; the last bucket has no bound and yields infinity.
+    '''
+    def quantile(self, q):
+        if self.Count == 0:
+            return None
+        rank, seen = q * self.Count, 0
+        for i in range(len(self.Counts)):
+            seen += self.Counts[i]
+            if seen >= rank and seen > 0:
+                break
+        return self.Bounds[i] if i < len(self.Bounds) else float('inf')
+
+class Registry:
+    '''
+    Metrics of a transfer by name. Counters and gauges are functions
+    reading what the hot path keeps track of anyway, only called for a
+    snapshot, so that they cost the transfer nothing; counters only ever
+    grow, which gives them a rate. Histograms are filled by the hot path,
+    at the cost of one bisection a sample.
+    '''
+    def __init__(self):
+        self.Counters, self.Gauges, self.Histograms = {}, {}, {}
+        self.Start = time.time()
+
+    def counter(self, name, read):
+        self.Counters[name] = read
+
+    def gauge(self, name, read):
+        self.Gauges[name] = read
+
+    def histogram(self, name, bounds=RTT_BOUNDS):
+        self.Histograms[name] = Histogram(bounds)
+        return self.Histograms[name]
+
+    '''
+    Current values as a dictionary, histograms as dictionaries of their
+    count, sum and cumulative count up to each bound.
+    '''
+    def snapshot(self):
+        result = {'uptime_seconds': time.time() - self.Start}
+        for name, read in list(self.Counters.items()) + \
+                          list(self.Gauges.items()):
+            result[name] = read()
+        for name, h in self.Histograms.items():
+            counts, total = list(h.Counts), 0
+            buckets = []
+            for i in range(len(h.Bounds)):
+                total += counts[i]
+                buckets.append([h.Bounds[i], total])
+            result[name] = {'count': h.Count, 'sum': h.Sum, \
+                            'buckets': buckets}
+        return result
+
+    '''
+    A snapshot in the text exposition format of Prometheus, one sample
+    a line.
+    '''
+    def render(self):
+        snapshot, lines = self.snapshot(), []
+        for name in sorted(snapshot):
+            value = snapshot[name]
+            if not isinstance(value, dict):
+                lines.append('%s %r' % (name, value))
+                continue
+            for bound, count in value['buckets']:
+                lines.append('%s_bucket{le="%g"} %d' % (name, bound, count))
+            lines.append('%s_bucket{le="+Inf"} %d' % (name, value['count']))
+            lines.append('%s_sum %r' % (name, value['sum']))
+            lines.append('%s_count %d' % (name, value['count']))
+        return '\n'.join(lines) + '\n'
+
+class Reporter:
+    '''
+    Print a summary line of the metrics names of registry to out every
+    interval seconds, from a daemon thread: the value of gauges, the
+    value and rate since the last line of counters, and the median and
+    99th percentile of histograms.
+    '''
+    def __init__(self, registry, interval, names, out=sys.stderr):
+        self.Registry, self.Interval, self.Names = registry, interval, names
+        self.Out, self.Last = out, {}
+        self.Stopped = threading.Event()
+        self.Thread = threading.Thread(target=self._run, args=())
+        self.Thread.daemon = True
+        self.Thread.start()
+
+    def _run(self):
+        while not self.Stopped.wait(self.Interval):
+            self.Out.write(self.summary() + '\n')
+            self.Out.flush()
+
+    '''
+    The next summary line.
+    '''
+    def summary(self):
+        registry, now = self.Registry, time.time()
+        fields = ['t=%.1f' % (now - registry.Start)]
+        for name in self.Names:
+            if name in registry.Counters:
+                value = registry.Counters[name]()
+                last = self.Last.get(name, (registry.Start, 0))
+                rate = (value - last[1]) / max(now - last[0], 1e-9)
+                self.Last[name] = (now, value)
+                fields.append('%s=%d(%.4g/s)' % (name, value, rate))
+            elif name in registry.Gauges:
+                fields.append('%s=%.4g' % (name, registry.Gauges[name]()))
+            elif name in registry.Histograms:
+                h = registry.Histograms[name]
+                if h.Count > 0:
+                    fields.append('%s:p50=%g,p99=%g' % \
+                                  (name, h.quantile(0.5), h.quantile(0.99)))
+        return ' '.join(fields)
+
+    def stop(self):
+        self.Stopped.set()
+
+class Endpoint:
+    '''
+    Serve snapshots of registry from a daemon thread. If address is a
+    port number, it is HTTP on 127.0.0.1: GET /json answers in JSON and
+    any other path in the text format. Otherwise address is the path of
+    a Unix socket, which writes the text format to every connection.
+    '''
+    def __init__(self, registry, address):
+        self.Registry, self.Path = registry, None
+        if str(address).isdigit():
+            self.Sok = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.Sok.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.Sok.bind(('127.0.0.1', int(address)))
+        else:
+            self.Path = address
+            if os.path.exists(address): # left by an earlier run
+                os.remove(address)
+            self.Sok = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.Sok.bind(address)
+        self.Sok.listen(5)
+        self.Thread = threading.Thread(target=self._serve, args=())
+        self.Thread.daemon = True
+        self.Thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, addr = self.Sok.accept()
+            except socket.error: # closed
+                return
+            try:
+                conn.sendall(self._answer(conn))
+            except socket.error:
+                pass
+            conn.close()
+
+    '''
+    Bytes to answer a connection with.
+    '''
+    def _answer(self, conn):
+        if self.Path is not None:
+            return self.Registry.render().encode()
+        request = b''
+        while b'\r\n\r\n' not in request and len(request) < 8192:
+            chunk = conn.recv(1024)
+            if not chunk:
+                break
+            request += chunk
+        words = request.split(b' ')
+        if len(words) > 1 and words[1].startswith(b'/json'):
+            body, kind = json.dumps(self.Registry.snapshot()), \
+                         'application/json'
+        else:
+            body, kind = self.Registry.render(), 'text/plain; version=0.0.4'
+        body = body.encode()
+        return ('HTTP/1.0 200 OK\r\nContent-Type: %s\r\n' \
+                'Content-Length: %d\r\n\r\n' % (kind, len(body))).encode() + \
+               body
+
+    def close(self):
+        self.Sok.close()
+        if self.Path is not None and os.path.exists(self.Path):
+            os.remove(self.Path)
+
+'''
+Start what reports on registry: a Reporter of names every interval
+seconds unless interval is None, and an Endpoint at address unless it is
+None. Returns them, to be stopped with stop().
+'''
+def start(registry, names, interval=None, address=None):
+    started = []
+    if interval is not None:
+        started.append(Reporter(registry, interval, names))
+    if address is not None:
+        started.append(Endpoint(registry, address))
+    return started
+
+'''
+Stop what start() started.
+'''
+def stop(started):
+    for item in started:
+        if isinstance(item, Reporter):
+            item.stop()
+        else:
+            item.close()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+'Pacing and token-bucket rate limiting of TCP sender.'
+
+__author__ = 'Sirui Tan'
+
+# The pacing rate is the congestion window per smoothed RTT times a gain,
+# so that the window still grows in slow start and the pipe stays full in
+# congestion avoidance (the gains of Linux fq pacing).
+SLOW_START_GAIN, AVOIDANCE_GAIN = 2.0, 1.2
+# Seconds of sending a paced sender may fall behind and make up for at
+# once, since the main loop cannot wake up for every single segment.
+QUANTUM = 0.001
+# Unless given, the token bucket holds what the rate fills in BUCKET_TIME
+# seconds, and at least MIN_BURST bytes. It grows to hold the largest
+# segment once the handshake tells it, see fit().
+BUCKET_TIME, MIN_BURST = 0.01, 3000
+
+class Pacer:
+    '''
+    Decide when the next segment may leave. With pace, segments are
+    spread over the RTT at the pacing rate instead of leaving back to back
+    whenever the window opens. With rate, a token bucket of burst bytes
+    refilled at rate bytes per second caps the sending rate, whatever the
+    window, retransmissions included.
+    '''
+    def __init__(self, pace=False, rate=None, burst=None):
+        self.Pace, self.Rate = pace, rate
+        self.Next = 0 # time the next segment may leave at the pacing rate
+        if rate is not None:
+            self.Burst = float(max(burst or rate * BUCKET_TIME, MIN_BURST))
+            self.Tokens, self.Stamp = self.Burst, None
+
+    '''
+    Make room in the token bucket for segments of size bytes, which could
+    never leave if it held fewer tokens.
+    '''
+    def fit(self, size):
+        if self.Rate is not None and size > self.Burst:
+            self.Tokens += size - self.Burst
+            self.Burst = float(size)
+
+    '''
+    Seconds until a segment of size bytes may leave, 0 if it may now.
+    '''
+    def wait(self, size, now):
+        delay = 0
+        if self.Pace:
+            delay = max(0, self.Next - now)
+        if self.Rate is not None:
+            self._refill(now)
+            if self.Tokens < size:
+                delay = max(delay, (size - self.Tokens) / self.Rate)
+        return delay
+
+    '''
+    A segment of size bytes left at now. cwnd is the congestion window and
+    srtt the smoothed RTT, 0 before the first sample, when nothing is paced
+    yet; slowStart tells which gain applies.
+    '''
+    def sent(self, size, now, cwnd, srtt, slowStart):
+        if self.Pace and srtt > 0:
+            gain = SLOW_START_GAIN if slowStart else AVOIDANCE_GAIN
+            self.Next = max(self.Next, now - QUANTUM) + \
+                        size * srtt / (gain * cwnd)
+        if self.Rate is not None:
+            self._refill(now)
+            self.Tokens -= size # may go below 0 for a retransmission
+
+    def _refill(self, now):
+        if self.Stamp is not None:
+            self.Tokens = min(self.Burst, \
+                              self.Tokens + (now - self.Stamp) * self.Rate)
+        self.Stamp = now
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+'Out-of-order reassembly buffer and received-block bitmap of TCP receiver.'
+
+__author__ = 'Sirui Tan'
+
+import heapq
+import bisect
+
+'''
+Unwrap the 32-bit sequence number seq to the 64-bit offset closest to the
+unwrapped offset ref.
+'''
+def unwrap(seq, ref):
+    delta = (seq - ref) & 0xFFFFFFFF
+    if delta >= 0x80000000: # seq is behind ref
+        delta -= 0x100000000
+    return ref + delta
+
+class ReorderBuffer:
+    '''
+    Segments received ahead of the expected one, keyed by unwrapped offset.
+
+    Segments maps a segment's head offset to its [tail, payload], so
+    duplicates are detected in O(1), and Heads is a heap of those offsets
+    from which contiguous runs are drained in O(log n) each. Starts maps
+    the start of every run of contiguous or overlapping segments to its
+    end, so that SACK blocks can be reported without scanning segments.
+    Runs never overlap or touch each other, and Runs keeps their starts
+    sorted, so that an arrival finds the runs to merge with by bisection
+    and drain pops those it reaches from the front.
+    '''
+    def __init__(self):
+        self.Segments, self.Heads = {}, []
+        self.Starts, self.Runs = {}, []
+        self.Bytes = 0 # payload bytes held
+        self.Recent = None # start of the run of the latest arrival
+
+    def __len__(self):
+        return len(self.Segments)
+
+    '''
+    Buffer payload received at offset head. Returns False for a duplicate.
+    '''
+    def insert(self, head, payload):
+        if head in self.Segments:
+            return False
+        tail = head + len(payload)
+        self.Segments[head] = [tail, payload]
+        heapq.heappush(self.Heads, head)
+        self.Bytes += len(payload)
+        # Merge every run the segment overlaps or touches: those starting
+        # up to tail, back to the last one ending before head. It is the
+        # neighbours on either side but when a segment received late
+        # spans the pieces of one received before.
+        start, end = head, tail
+        last = bisect.bisect_right(self.Runs, tail)
+        first = last
+        while first > 0 and self.Starts[self.Runs[first - 1]] >= head:
+            first -= 1
+            other = self.Runs[first]
+            start = min(start, other)
+            end = max(end, self.Starts.pop(other))
+        self.Runs[first:last] = [start]
+        self.Starts[start] = end
+        self.Recent = start
+        return True
+
+    '''
+    Remove the payloads contiguous from offset expected, which the caller
+    has already received up to. Returns them along with the new expected
+    offset.
+    '''
+    def drain(self, expected):
+        payloads = []
+        if self.Heads == [] or self.Heads[0] > expected:
+            return payloads, expected
+        while self.Heads != [] and self.Heads[0] <= expected:
+            head = heapq.heappop(self.Heads)
+            tail, payload = self.Segments.pop(head)
+            self.Bytes -= len(payload)
+            if tail > expected: # skip what overlaps data already received
+                payloads.append(payload[expected - head:])
+                expected = tail
+        # Runs started below expected are gone, but for the rest of one
+        # that goes beyond it, which stays buffered.
+        while self.Runs != [] and self.Runs[0] < expected:
+            start = self.Runs.pop(0)
+            end = self.Starts.pop(start)
+            if end > expected:
+                self.Starts[expected] = end
+                self.Runs.insert(0, expected)
+            if self.Recent == start:
+                self.Recent = expected if end > expected else None
+        return payloads, expected
+
+    '''
+    At most limit [start, end) runs for SACK, the latest arrival's first
+    as RFC 2018 asks, then the others in ascending order.
+    '''
+    def blocks(self, limit):
+        if self.Starts == {}:
+            return []
+        result = []
+        if self.Recent in self.Starts:
+            result.append([self.Recent, self.Starts[self.Recent]])
+        for start in self.Runs:
+            if len(result) >= limit:
+                break
+            if start != self.Recent:
+                result.append([start, self.Starts[start]])
+        return result
+
+class BlockBitmap:
+    '''
+    Which blocks of Unit bytes beyond the expected offset have been
+    received, for payloads written straight to their place in the file.
+
+    Bit i of Mask stands for the block at offset (Base + i) * Unit, so the
+    cumulative ACK advances over the run of ones at the bottom. Segments
+    start on a block boundary and cover whole blocks, but for the last one
+    of the stream whose tail is kept in End. The expected offset starts at
+    start, a block boundary.
+    '''
+    def __init__(self, unit, start=0):
+        self.Unit, self.Mask, self.Base = unit, 0, start // unit
+        self.End = None # tail of the short segment ending the stream
+        self.Bytes = 0 # payload bytes held, none as they are on disk
+        self.Recent = None # offset of the latest arrival
+
+    def __len__(self):
+        return bin(self.Mask).count('1')
+
+    '''
+    Mark length bytes received at offset head, which must not be before
+    the expected offset. Returns False for a duplicate or a segment not
+    aligned on blocks.
+    '''
+    def insert(self, head, length):
+        if head % self.Unit != 0 or length == 0:
+            return False
+        first = head // self.Unit - self.Base
+        bits = ((1 << ((length + self.Unit - 1) // self.Unit)) - 1) << first
+        if self.Mask & bits == bits:
+            return False
+        self.Mask |= bits
+        if length % self.Unit != 0:
+            self.End = head + length
+        self.Recent = head
+        return True
+
+    '''
+    Advance over the blocks contiguous from the expected offset. Returns
+    the new expected offset.
+    '''
+    def drain(self, expected):
+        ones = (~self.Mask & (self.Mask + 1)).bit_length() - 1
+        if ones == 0:
+            return expected
+        self.Mask >>= ones
+        self.Base += ones
+        return self._offset(self.Base)
+
+    '''
+    Offset of the block with index n, bounded by the end of the stream.
+    '''
+    def _offset(self, n):
+        if self.End is not None:
+            return min(n * self.Unit, self.End)
+        return n * self.Unit
+
+    '''
+    At most limit [start, end) runs for SACK, the latest arrival's first
+    as RFC 2018 asks, then the others in ascending order.
+    '''
+    def blocks(self, limit):
+        runs, mask, n = [], self.Mask, self.Base
+        while mask:
+            zeros = (mask & -mask).bit_length() - 1
+            mask >>= zeros
+            n += zeros
+            ones = (~mask & (mask + 1)).bit_length() - 1
+            mask >>= ones
+            runs.append([self._offset(n), self._offset(n + ones)])
+            n += ones
+        result = [run for run in runs if run[0] <= self.Recent < run[1]]
+        for run in runs:
+            if len(result) >= limit:
+                break
+            if run not in result:
+                result.append(run)
+        return result
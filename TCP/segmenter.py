@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+'Lazy, memory-mapped segment source used by TCP sender.'
+
+__author__ = 'Sirui Tan'
+
+import mmap
+import os
+import zlib
+
+# Bytes of data compressed at a time by a Deflater.
+CHUNK = 1 << 20
+
+class Segmenter:
+    '''
+    Hand out segments of a file by byte offset without loading the file.
+
+    The file is memory-mapped read-only, so opening it costs constant time
+    regardless of its size and pages are brought in by the OS only when the
+    corresponding segments are sent. Segments are returned as zero-copy
+    slices of the mapping (memoryview where the mapping supports it,
+    buffer otherwise).
+
+    Offsets are relative to Start, which allows a Segmenter to cover only a
+    byte range [Start, Start + Length) of the underlying file.
+    '''
+    def __init__(self, fileName, segSize, start=0, length=None):
+        self.File = open(fileName, 'rb')
+        fileSize = os.fstat(self.File.fileno()).st_size
+        self.SegSize, self.Start = segSize, min(start, fileSize)
+        if length is None or self.Start + length > fileSize:
+            length = fileSize - self.Start
+        self.Length = length
+        self.Map, self.View = None, None
+        if fileSize > 0: # Zero-length files cannot be mapped
+            self.Map = mmap.mmap(self.File.fileno(), 0, \
+                                 access=mmap.ACCESS_READ)
+            try:
+                self.View = memoryview(self.Map)
+            except TypeError: # mmap has no new-style buffer on Python 2
+                self.View = None
+
+    '''
+    Return the segment beginning at offset, or an empty slice at the end.
+    '''
+    def get(self, offset, size=None):
+        if size is None:
+            size = self.SegSize
+        size = max(0, min(size, self.Length - offset))
+        pos = self.Start + offset
+        if self.View is not None:
+            return self.View[pos:pos + size]
+        if self.Map is None:
+            return b''
+        return buffer(self.Map, pos, size)
+
+    '''
+    Length of the segment of at most size bytes beginning at offset.
+    '''
+    def size(self, offset, size):
+        return max(0, min(size, self.Length - offset))
+
+    '''
+    Whether there is still data at or after offset.
+    '''
+    def hasMore(self, offset):
+        return offset < self.Length
+
+    '''
+    Release the mapping and the underlying file.
+    '''
+    def close(self):
+        self.View = None
+        if self.Map is not None:
+            self.Map.close()
+            self.Map = None
+        self.File.close()
+
+class Deflater:
+    '''
+    Hand out segments of the data of a Segmenter compressed by zlib at
+    level, as a Segmenter does, by offset within the compressed stream.
+
+    The data is compressed CHUNK bytes at a time, only once a segment
+    asked for goes beyond what is compressed, so the first segment leaves
+    at once whatever the size of the data. Segments are asked for in
+    order and once each, as retransmissions resend the packets held in
+    UnackBuffer, so the compressed bytes before the last segment handed
+    out are dropped with the next chunk: Data holds the compressed stream
+    from offset Base, a chunk's worth or so. Length is the length of the
+    stream compressed so far, final once Done.
+
+    The data read is also fed to digest, a hashlib object, if given.
+    '''
+    def __init__(self, segments, level, digest=None):
+        self.Source, self.Digest = segments, digest
+        self.SegSize = segments.SegSize
+        self.Compressor = zlib.compressobj(level)
+        self.Read, self.Done = 0, False # bytes of the data compressed
+        self.Data, self.Base, self.Length = b'', 0, 0
+        self.Handed = 0 # offset of the last segment handed out
+
+    '''
+    Compress the next chunk of the data, or flush the compressor once it
+    is all read.
+    '''
+    def _compress(self):
+        if self.Read < self.Source.Length:
+            data = self.Source.get(self.Read, CHUNK)
+            self.Read += len(data)
+            if self.Digest is not None:
+                self.Digest.update(data)
+            out = self.Compressor.compress(data)
+        else:
+            out, self.Done = self.Compressor.flush(), True
+        # A new bytes object, so that segments still viewed keep the old one
+        self.Data = self.Data[self.Handed - self.Base:] + out
+        self.Base = self.Handed
+        self.Length = self.Base + len(self.Data)
+
+    '''
+    Length of the segment of at most size bytes beginning at offset,
+    compressing the data as far as it takes.
+    '''
+    def size(self, offset, size):
+        while offset + size > self.Length and not self.Done:
+            self._compress()
+        return max(0, min(size, self.Length - offset))
+
+    '''
+    Return the segment beginning at offset, or an empty slice at the end.
+    '''
+    def get(self, offset, size=None):
+        size = self.size(offset, self.SegSize if size is None else size)
+        self.Handed = offset
+        return memoryview(self.Data)[offset - self.Base:\
+                                     offset - self.Base + size]
+
+    '''
+    Whether there is still data at or after offset.
+    '''
+    def hasMore(self, offset):
+        return self.size(offset, 1) > 0
+
+    '''
+    Release the data and the underlying Segmenter.
+    '''
+    def close(self):
+        self.Data = b''
+        self.Source.close()
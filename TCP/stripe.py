@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+'Striped transfer of one file over parallel TCP sender and receiver pairs.'
+
+__author__ = 'Sirui Tan'
+
+import sys
+import os
+import getopt
+import shutil
+import tempfile
+import time
+import multiprocessing
+from TCP_send import Sender, MSS, localMSS
+from TCP_recv import Receiver
+
+'''
+Bytes of each stripe: the file split evenly, rounded up to whole segments
+so that only the last segment of a stripe may be short.
+'''
+def share(size, stripes):
+    unit = MSS - 20
+    each = (size + stripes - 1) // stripes
+    return (each + unit - 1) // unit * unit
+
+def _send(job):
+    fileName, rIP, rPort, aPort, logName, windowSize, kw = job
+    Sender(fileName, rIP, rPort, aPort, logName, windowSize, **kw).run()
+
+def _receive(job):
+    fileName, lPort, sIP, sPort, logName, kw = job
+    r = Receiver(fileName, lPort, sIP, sPort, logName, **kw)
+    r.run()
+    return r.Verified
+
+'''
+Send fileName as stripes byte ranges, stripe i from ack port aPort + i to
+remote port rPort + i, each by a Sender of its own process. A manifest
+holding the file's size follows on the next pair of ports.
+'''
+def send(fileName, rIP, rPort, aPort, logName, stripes, windowSize=None, \
+         **kw):
+    if not os.path.isfile(fileName):
+        print('File to be sent not found, terminating...')
+        return False
+    size = os.path.getsize(fileName)
+    each = share(size, stripes)
+    fd, manifest = tempfile.mkstemp()
+    os.write(fd, ('%d\n' % size).encode())
+    os.close(fd)
+    jobs = [(fileName, rIP, rPort + i, aPort + i, '%s.%d' % (logName, i), \
+             windowSize, dict(kw, start=i * each, length=each)) \
+            for i in range(stripes)]
+    jobs.append((manifest, rIP, rPort + stripes, aPort + stripes, \
+                 '%s.%d' % (logName, stripes), windowSize, kw))
+    start = time.time()
+    pool = multiprocessing.Pool(stripes + 1)
+    pool.map(_send, jobs)
+    pool.close()
+    pool.join()
+    elapsed = time.time() - start
+    os.remove(manifest)
+    print('Striped delivery of %d bytes in %.3f s, %.2f Mbit/s. ' % \
+          (size, elapsed, size * 8 / elapsed / 1e6))
+    return True
+
+'''
+Receive the stripes sent by send() on ports lPort to lPort + stripes,
+each into a part file by a Receiver of its own process, then concatenate
+them into fileName. Each stripe, the manifest included, is checked against
+the digest its FIN carries, and the file against the size in the manifest.
+'''
+def receive(fileName, lPort, sIP, sPort, logName, stripes, **kw):
+    parts = ['%s.part%d' % (fileName, i) for i in range(stripes + 1)]
+    jobs = [(parts[i], lPort + i, sIP, sPort + i, '%s.%d' % (logName, i), \
+             kw) for i in range(stripes + 1)]
+    pool = multiprocessing.Pool(stripes + 1)
+    verified = pool.map(_receive, jobs)
+    pool.close()
+    pool.join()
+    out = open(fileName, 'wb')
+    for part in parts[:-1]:
+        f = open(part, 'rb')
+        shutil.copyfileobj(f, out, 1 << 20)
+        f.close()
+        os.remove(part)
+    out.close()
+    f = open(parts[-1], 'rb')
+    expected = f.read().split()
+    f.close()
+    os.remove(parts[-1])
+    ok = all(verified) and len(expected) == 1 and \
+         os.path.getsize(fileName) == int(expected[0])
+    if ok:
+        print('Integrity check passed. ')
+    else:
+        print('Integrity check FAILED. ')
+    return ok
+
+if __name__ == '__main__':
+    # python stripe.py send [options] <filename> <remote_IP> <remote_port>
+    #     <ack_port_num> <log_filename> <stripes> [<window_size>]
+    # python stripe.py recv [options] <filename> <listening_port>
+    #     <sender_IP> <sender_port> <log_filename> <stripes>
+    # Options are those of TCP_send.py and TCP_recv.py respectively, but
+    # for -b, -I and -E, and apply to every stripe; -r caps the rate of each
+    # stripe and -z compresses each on its own.
+    if len(sys.argv) < 2 or sys.argv[1] not in ('send', 'recv'):
+        print('Usage: python stripe.py send|recv [options] <arguments>')
+        sys.exit(1)
+    sending = sys.argv[1] == 'send'
+    opts, args = getopt.gnu_getopt(sys.argv[2:], \
+                                   'ec:sn:Mpr:k:S:Pz:' if sending \
+                                   else 'sn:dw:pMS:R')
+    para, kw = [sys.argv[0]] + args, {}
+    for opt, val in opts:
+        if opt == '-e':
+            kw['engine'] = 'event'
+        elif opt == '-c':
+            kw['cc'] = val
+        elif opt == '-s':
+            kw['sack'] = True
+        elif opt == '-n':
+            kw['logSample'] = int(val)
+        elif opt == '-d':
+            kw['delayedAck'] = True
+        elif opt == '-w':
+            kw['bufferSize'] = int(val)
+        elif opt == '-p':
+            kw['pace' if sending else 'positional'] = True
+        elif opt == '-r':
+            kw['rate'] = float(val) * 1000 / 8
+        elif opt == '-k':
+            kw['burst'] = int(val)
+        elif opt == '-M':
+            kw['mmsg'] = True
+        elif opt == '-S':
+            kw['mss'] = localMSS(para[2]) if val == 'mtu' else int(val)
+        elif opt == '-P':
+            kw['probe'] = True
+        elif opt == '-R':
+            kw['resume'] = True
+        elif opt == '-z':
+            kw['compress'] = int(val)
+    if sending:
+        windowSize = int(para[7]) if len(para) > 7 else None
+        ok = send(para[1], para[2], int(para[3]), int(para[4]), para[5], \
+                  int(para[6]), windowSize, **kw)
+    else:
+        ok = receive(para[1], int(para[2]), para[3], int(para[4]), para[5], \
+                     int(para[6]), **kw)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,137 @@
+"""Benchmark of Router.update_dv on large random topologies.
+
+A router with a given number of neighbors learns routes to every node of a
+random graph from its neighbors' distance vectors. A stream of messages is
+then replayed on it: ROUTE UPDATE messages carrying a neighbor's whole
+vector with a few costs changed, as a link elsewhere would change them, and
+now and then a LINK DOWN followed later by a LINK UP. The time to handle
+them is compared between the incremental update_dv and a router that
+recomputes every destination on every message. Both must end with the same
+costs; next hops may differ where routes tie, as neither changes the next
+hop of a destination whose cost stays the same.
+
+Usage: python bench_router.py [nodes] [neighbors] [messages] [seed]
+"""
+import random
+import sys
+import time
+from router import Router
+
+class FullRouter(Router):
+    """Router recomputing every destination against every neighbor on
+    every message, the way update_dv did before it was incremental."""
+    def update_dv(self, changed=None):
+        return Router.update_dv(self)
+
+def node_name(i):
+    """Name of node i in <IP>:<port> format."""
+    return '127.0.0.1:%d' % (10000 + i)
+
+def make_vectors(nodes, neighbors, rand):
+    """Distance vectors of the neighbors, each with a cost to every node.
+
+    Args:
+        nodes: Integer of the number of nodes in the graph.
+        neighbors: Integer of the number of neighbors of the router.
+        rand: random.Random instance.
+
+    Returns:
+        List of dictionaries from node name to cost, one per neighbor, the
+        neighbor's own entry being 0.
+    """
+    vectors = []
+    for n in range(neighbors):
+        base = rand.uniform(0, 20)
+        dv = dict((node_name(i), float(int(base + rand.uniform(1, 50)))) \
+                  for i in range(nodes))
+        dv[node_name(n + 1)] = 0.
+        vectors.append(dv)
+    return vectors
+
+def make_messages(vectors, count, changes, rand):
+    """Messages to replay, as tuples of (type, neighbor index, lines).
+
+    Args:
+        vectors: List of the neighbors' distance vectors, modified as the
+            messages change them.
+        count: Integer of the number of messages.
+        changes: Integer of the number of costs a route update changes.
+        rand: random.Random instance.
+
+    Returns:
+        List of messages, lines being None for link up and link down.
+    """
+    messages, down = [], None
+    names = sorted(vectors[0])
+    for k in range(count):
+        if down is not None and rand.random() < 0.1:
+            messages.append(('LINK UP', down, None))
+            down = None
+            continue
+        if down is None and rand.random() < 0.02:
+            down = rand.randrange(len(vectors))
+            messages.append(('LINK DOWN', down, None))
+            continue
+        n = rand.randrange(len(vectors))
+        if n == down:
+            continue
+        dv = vectors[n]
+        for name in rand.sample(names, changes):
+            if dv[name] > 0:
+                dv[name] = max(1., dv[name] + rand.choice([-5., -1., 1., 5.]))
+        lines = [','.join(name.split(':') + [str(dv[name])]) for name in names]
+        messages.append(('ROUTE UPDATE', n, lines))
+    return messages
+
+def replay(router, vectors, messages):
+    """Feed the initial vectors then the messages to router.
+
+    Returns:
+        Float number of seconds spent handling the messages.
+    """
+    neighbors = [router.neighbors[node_name(n + 1)] \
+                 for n in range(len(vectors))]
+    for n in range(len(vectors)):
+        router.route_update(neighbors[n], \
+                            [','.join(name.split(':') + [str(cost)]) \
+                             for name, cost in vectors[n].items()])
+    start = time.time()
+    for kind, n, lines in messages:
+        if kind == 'ROUTE UPDATE':
+            router.route_update(neighbors[n], lines)
+        elif kind == 'LINK DOWN':
+            router.link_down_respond(neighbors[n])
+        else:
+            router.link_up_respond(neighbors[n])
+    return time.time() - start
+
+def build(cls, neighbors):
+    """A router of class cls with the given number of neighbors, nodes 1
+    to neighbors, at distance 1 to 10."""
+    router = cls(0, 3.)
+    for n in range(neighbors):
+        router.init_neighbor('127.0.0.1', 10001 + n, float(n % 10 + 1))
+    return router
+
+if __name__ == '__main__':
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    neighbors = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 300
+    seed = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    rand = random.Random(seed)
+    initial = make_vectors(nodes, neighbors, rand)
+    vectors = [dict(dv) for dv in initial]
+    messages = make_messages(vectors, count, 5, rand)
+    results = []
+    for cls in (FullRouter, Router):
+        router = build(cls, neighbors)
+        elapsed = replay(router, [dict(dv) for dv in initial], messages)
+        results.append((elapsed, router))
+        print('{:<12}{:.3f} s, {:.3f} ms per message'.format( \
+              cls.__name__, elapsed, elapsed * 1000 / len(messages)))
+    costs = [dict((name, entry.cost) for name, entry in \
+                  router.distance_vector.items()) \
+             for elapsed, router in results]
+    print('{} nodes, {} neighbors, {} messages: {:.1f}x faster, costs {}'.format( \
+          nodes, neighbors, len(messages), results[0][0] / results[1][0], \
+          'match' if costs[0] == costs[1] else 'DIFFER'))
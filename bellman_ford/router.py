@@ -21,6 +21,8 @@ class Router(object):
         neighbors: Dictionary of Neighbor objects.
         distance_vector: Dictionary of OtherRouter objects, which is in
             fact the host router's own DV table.
+        routes_via: Dictionary of sets of the destinations in
+            distance_vector, keyed by the name of their next-hop router.
     """
     class Neighbor(object):
         """Used as elements of Router's neighbor table.
@@ -28,6 +30,7 @@ class Router(object):
         Attributes:
             addr: string representing IP address of neighbor.
             port: Float number representing port number of neighbor.
+            name: String of the name of neighbor in <IP>:<port> format.
             weight: Float number representing weight of the edge to
                 neighbor.
             sok: An UDP socket for sending messages to underlying
@@ -41,6 +44,8 @@ class Router(object):
                 is silent for too long to be kept alive.
             is_killed: Boolean to tell send thread whether this neighbor
                 is reachable or not.
+            was_killed: Value of is_killed when the host's DV table was
+                last updated.
             *_ready: Boolean flags to tell send thread if certain message
                 should be send out.
         """
@@ -57,11 +62,12 @@ class Router(object):
                 None.
             """
             self.addr, self.port = addr, port
+            self.name = ':'.join([addr, str(port)])
             self.weight = weight
             self.sok = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.distance_vector = dict()
             self.send_timer, self.kill_timer = time.time(), time.time()
-            self.is_killed = False
+            self.is_killed, self.was_killed = False, False
             self.update_ready, self.linkup_ready, self.linkdown_ready = True, False, False
 
         def dv_update(self, dv_list):
@@ -72,13 +78,17 @@ class Router(object):
                     fields of node IP, node port and node path cost.
 
             Returns:
-                None.
+                Set of the names of the nodes whose cost is new or changed.
             """
+            changed = set()
             for line in dv_list:
                 line_sep = line.split(',')
                 other_name = line_sep[0] + ':' + line_sep[1]
                 other_cost = float(line_sep[2])
-                self.distance_vector[other_name] = other_cost
+                if self.distance_vector.get(other_name) != other_cost:
+                    self.distance_vector[other_name] = other_cost
+                    changed.add(other_name)
+            return changed
 
     class OtherRouter(object):
         """Elements of Router's distance_vector attribute.
@@ -109,6 +119,7 @@ class Router(object):
         self.neighbors = dict()
         self.distance_vector = dict()
         self.distance_vector[self.name_str] = Router.OtherRouter(0., self.name_str)
+        self.routes_via = {self.name_str: set([self.name_str])}
 
     def init_neighbor(self, addr, port, weight):
         """Add a new neighbor to neighbors list.
@@ -124,6 +135,7 @@ class Router(object):
         neighbor_name = ':'.join([addr, str(port)])
         self.neighbors[neighbor_name] = Router.Neighbor(addr, port, weight)
         self.distance_vector[neighbor_name] = Router.OtherRouter(weight, neighbor_name)
+        self.routes_via.setdefault(neighbor_name, set()).add(neighbor_name)
 
     def run(self):
         """The main life cycle of a router.
@@ -391,12 +403,12 @@ class Router(object):
         """
         neighbor.is_killed = False
         neighbor.kill_timer = time.time()
-        neighbor.dv_update(dv_list)
-        # Iterate to see if new node is included in the graph.
-        for name in neighbor.distance_vector:
+        changed = neighbor.dv_update(dv_list)
+        # New nodes of the graph are among the changed ones.
+        for name in changed:
             if name not in self.distance_vector:
                 self.distance_vector[name] = Router.OtherRouter(float('Inf'), None)
-        if self.update_dv():
+        if self.update_dv(changed):
             for name in self.neighbors:
                 self.neighbors[name].update_ready = True
                 self.neighbors[name].send_timer = time.time()
@@ -411,7 +423,7 @@ class Router(object):
             None.
         """
         neighbor.is_killed = True
-        if self.update_dv():
+        if self.update_dv(set()):
             for name in self.neighbors:
                 self.neighbors[name].update_ready = True
                 self.neighbors[name].send_timer = time.time()
@@ -428,43 +440,95 @@ class Router(object):
         neighbor.is_killed = False
         neighbor.send_timer = time.time()
         neighbor.kill_timer = time.time()
-        if self.update_dv():
+        if self.update_dv(set()):
             for name in self.neighbors:
                 self.neighbors[name].update_ready = True
                 self.neighbors[name].send_timer = time.time()
 
-    def update_dv(self):
+    def update_dv(self, changed=None):
         """The process of updating dv.
 
         The dv is updated elementwisely according to neighbors' dv entries.
         A flag would be set if the dv changes during the update.
 
+        Only the destinations that may have changed are recomputed: those
+        in changed, those routed via a neighbor killed since the last update
+        and those a neighbor resurrected since then can reach. Other
+        destinations keep their cost, as no neighbor's cost to them changed.
+
         Args:
-            None.
+            changed: Set of the destinations whose cost changed in a
+                neighbor's DV table, or None to recompute every destination.
 
         Returns:
             Boolean flag indicating whether the dv changes or not.
         """
+        if changed is None:
+            affected = self.distance_vector
+        else:
+            affected = set(changed)
+        for neighbor in self.neighbors.values():
+            if neighbor.is_killed != neighbor.was_killed:
+                neighbor.was_killed = neighbor.is_killed
+                if changed is None:
+                    continue
+                if neighbor.is_killed:
+                    affected.update(self.routes_via.get(neighbor.name, ()))
+                else:
+                    affected.update(neighbor.distance_vector)
         is_changed = False
-        for name in self.distance_vector:
-            smallest = float('Inf')
-            smallest_neighbor = None
-            for neighbor_name in self.neighbors:
-                if self.neighbors[neighbor_name].is_killed:
+        for name in affected:
+            if name == self.name_str or name not in self.distance_vector:
+                continue
+            smallest, smallest_neighbor = self.best_route(name)
+            entry = self.distance_vector[name]
+            # A new next hop at the same cost is recorded too, so that
+            # routes_via leads a later link down to this destination.
+            if entry.cost != smallest or entry.link != smallest_neighbor:
+                is_changed = is_changed or entry.cost != smallest
+                self.set_route(name, smallest, smallest_neighbor)
+        return is_changed
+
+    def best_route(self, name):
+        """Find the cheapest route to a destination among the neighbors.
+
+        Args:
+            name: String of the destination in <IP>:<port> format.
+
+        Returns:
+            Tuple of the route cost and the name of the next-hop neighbor,
+            which is None if the destination is unreachable.
+        """
+        smallest = float('Inf')
+        smallest_neighbor = None
+        for neighbor_name, neighbor in self.neighbors.items():
+            if name in neighbor.distance_vector:
+                if neighbor.is_killed:
                     weight = float('Inf')
                 else:
-                    weight = self.neighbors[neighbor_name].weight
-                if name in self.neighbors[neighbor_name].distance_vector:
-                    candidate = self.neighbors[neighbor_name].distance_vector[name]
-                    candidate += weight
-                    if smallest > candidate:
-                        smallest = candidate
-                        smallest_neighbor = neighbor_name
-            if self.distance_vector[name].cost != smallest and name != self.name_str:
-                self.distance_vector[name].cost = smallest
-                self.distance_vector[name].link = smallest_neighbor
-                is_changed = True
-        return is_changed
+                    weight = neighbor.weight
+                candidate = neighbor.distance_vector[name] + weight
+                if smallest > candidate:
+                    smallest = candidate
+                    smallest_neighbor = neighbor_name
+        return smallest, smallest_neighbor
+
+    def set_route(self, name, cost, link):
+        """Set the route to a destination, keeping routes_via up to date.
+
+        Args:
+            name: String of the destination in <IP>:<port> format.
+            cost: Float number of the route cost.
+            link: String of the name of the next-hop router, or None.
+
+        Returns:
+            None.
+        """
+        entry = self.distance_vector[name]
+        if entry.link in self.routes_via:
+            self.routes_via[entry.link].discard(name)
+        entry.cost, entry.link = cost, link
+        self.routes_via.setdefault(link, set()).add(name)
 
 if __name__ == '__main__':
     local_port, time_out = sys.argv[1], sys.argv[2]